@@ -24,13 +24,18 @@ import multiprocessing as mp
 import configparser
 from argparse import ArgumentParser
 import starsfile
+import starsutil
 import starskernel
 import starskernelmp
+import starsrecorder
 
 DEFAULT_PORT = 6057
 LIBDIR = 'takaserv-lib'
 KEYDIR = None
 CONFIGFILE = 'PyStars.cfg'
+SERVERMODES = ('single', 'multi', 'async', 'pool')
+TRANSPORTS = ('queue', 'shm')
+ASSIGNMODES = ('load', 'hash')
 
 def readconfigfile(cfile):
     cfg = configparser.ConfigParser(allow_no_value=True)
@@ -38,8 +43,27 @@ def readconfigfile(cfile):
     starsport = cfg.getint("param", "starsport")
     starslib = cfg["param"]["starslib"]
     starskey = cfg["param"]["starskey"]
-    starsmulti = cfg.getboolean("param", "starsmulti")
-    return [starsmulti, starsport, starslib, starskey]
+    starsmulti = cfg.getboolean("param", "starsmulti", fallback=False)
+    starsmode = cfg.get("param", "starsmode", fallback=None)
+    if not starsmode:
+        starsmode = 'multi' if starsmulti else 'single'
+    if starsmode not in SERVERMODES:
+        print('Unknown starsmode \'{}\', single thread server will be used.'.format(starsmode))
+        starsmode = 'single'
+    starsmaxline = cfg.get("param", "starsmaxline", fallback=None)
+    starsmaxline = int(starsmaxline) if starsmaxline else None
+    starsiponly = cfg.getboolean("param", "starsiponly", fallback=False)
+    starsworkers = cfg.get("param", "starsworkers", fallback=None)
+    starsworkers = int(starsworkers) if starsworkers else None
+    starsassign = cfg.get("param", "starsassign", fallback=None) or 'load'
+    starstransport = cfg.get("param", "starstransport", fallback=None) or 'queue'
+    starsmetricsport = cfg.get("param", "starsmetricsport", fallback=None)
+    starsmetricsport = int(starsmetricsport) if starsmetricsport else None
+    starsrecorderfile = cfg.get("param", "starsrecorder", fallback=None)
+    starsrecordersize = cfg.get("param", "starsrecordersize", fallback=None)
+    starsrecordersize = int(starsrecordersize) if starsrecordersize else 0
+    return [starsmode, starsport, starslib, starskey, starsmaxline, starsiponly, starsworkers, starsassign,
+            starstransport, starsmetricsport, starsrecorderfile, starsrecordersize]
 
 def readparameter():
     _parser = ArgumentParser(description='STARS Server Version: {}'.format(__version__))
@@ -47,20 +71,60 @@ def readparameter():
     _parser.add_argument('-lib', dest='l', help='Directory with server .cfg files and .key files.', default=LIBDIR)
     _parser.add_argument('-key', dest='k', help='Directory with server .key files.'\
                         'If empty lib directory will be used.', default=KEYDIR)
-    _parser.add_argument('-multi', dest='m', help='Switch to multiprocessing mode.'\
+    _mode = _parser.add_mutually_exclusive_group()
+    _mode.add_argument('-multi', dest='m', help='Switch to multiprocessing mode.'\
                         'If this switch will be configured, the multiprocessing version of STARS server will be used.',
-                         action='store_true')
+                         action='store_const', const='multi', default='single')
+    _mode.add_argument('-async', dest='m', help='Switch to asyncio mode.'\
+                        'If this switch will be configured, the asyncio version of STARS server will be used.',
+                         action='store_const', const='async')
+    _mode.add_argument('-pool', dest='m', help='Switch to worker pool mode.'\
+                        'If this switch will be configured, a fixed number of worker processes serves all nodes.',
+                         action='store_const', const='pool')
+    _parser.add_argument('-maxline', dest='ml', type=int, help='Maximum length of one message line in bytes.'\
+                        'Connections sending longer lines will be closed.', default=None)
+    _parser.add_argument('-iponly', dest='ip', help='Do not resolve host names.'\
+                        'IP addresses will be used for host checks.', action='store_true')
+    _parser.add_argument('-workers', dest='w', type=int, help='Number of worker processes in pool mode.'\
+                        'If empty one per CPU core.', default=None)
+    _parser.add_argument('-assign', dest='a', choices=ASSIGNMODES,
+                        help='Assignment of nodes to workers in pool mode: least load or node name hash.', default='load')
+    _parser.add_argument('-transport', dest='t', choices=TRANSPORTS,
+                        help='Message transport between the processes in multiprocessing mode.', default='queue')
+    _parser.add_argument('-metricsport', dest='mp', type=int, help='Port of the metrics endpoint on localhost.'\
+                        'If empty no endpoint is started.', default=None)
+    _parser.add_argument('-recorder', dest='r', help='Flight recorder file in the lib directory.'\
+                        'It holds the start of every message body.', default=starsrecorder.RECORDER_FILE)
+    _parser.add_argument('-recordersize', dest='rs', type=int, help='Size of the flight recorder file in MB.'\
+                        'If 0 the recorder is off.', default=starsrecorder.RECORDER_SIZE)
     args = _parser.parse_args()
-    return [args.m, args.p, args.l, args.k]
+    return [args.m, args.p, args.l, args.k, args.ml, args.ip, args.w, args.a, args.t, args.mp, args.r, args.rs]
 
 def chooseversion(param):
-    if param[0]:
+    starsutil.set_iponly(param[5])
+    if param[0] == 'multi':
         mp.set_start_method('spawn')
         print('Starting multiprocessing server...')
-        return starskernelmp.Starsserver(port=param[1], lib=param[2], key=param[3])
+        return starskernelmp.Starsserver(port=param[1], lib=param[2], key=param[3], maxline=param[4],
+                                         transport=param[8], metricsport=param[9], recorder=param[10],
+                                         recordersize=param[11])
+    elif param[0] == 'pool':
+        mp.set_start_method('spawn')
+        print('Starting worker pool server...')
+        #Imported here, the kernel modules import this file while they are loading.
+        import starskernelpool
+        return starskernelpool.Starsserver(port=param[1], lib=param[2], key=param[3], maxline=param[4],
+                                           workers=param[6], assign=param[7], metricsport=param[9],
+                                           recorder=param[10], recordersize=param[11])
+    elif param[0] == 'async':
+        print('Starting asyncio server...')
+        import starskernelasync
+        return starskernelasync.Starsserver(port=param[1], lib=param[2], key=param[3], maxline=param[4],
+                                            metricsport=param[9], recorder=param[10], recordersize=param[11])
     else:
         print('Starting single thread server...')
-        return starskernel.Starsserver(port=param[1], lib=param[2], key=param[3])
+        return starskernel.Starsserver(port=param[1], lib=param[2], key=param[3], maxline=param[4],
+                                       metricsport=param[9], recorder=param[10], recordersize=param[11])
 
 if __name__ == "__main__":
     print('\nSTARS Server Version: {}'.format(__version__))
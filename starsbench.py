@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+"""STARS Server microbenchmarks.
+
+Runs the hot helper functions of the server in a loop and prints
+operations per second. Usage:
+
+    python starsbench.py [benchmark ...] [-baseline FILE] [-threshold 0.3] [-save]
+
+Without benchmark names all benchmarks are run. The tables (allow.cfg,
+command permissions, reconnectable lists, key files, flgon subscriptions)
+have TABLE_SIZE entries. Results are compared with the stored baselines;
+a result slower than the baseline by more than the threshold fraction
+is reported and the exit code is 1. -save stores the results as new
+baselines. Baselines depend on the machine, so the file records the
+machine it was saved on and results are only compared on that machine;
+run -save once before the first comparison. The legacy variants are the
+old implementations, printed as reference and never compared.
+"""
+import atexit
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import multiprocessing as mp
+from argparse import ArgumentParser
+import starsutil
+import starsring
+import starsrecorder
+
+BENCH_SECONDS = 1.0
+TRANSPORT_MESSAGES = 100000
+TABLE_SIZE = 300
+BASELINEFILE = os.path.join(starsutil.SERVERDIR, 'starsbench.json')
+THRESHOLD = 0.3
+REFERENCE_VARIANTS = ('legacy',)
+
+SAMPLE_MESSAGES = [
+    'Dev1 GetValue',
+    'Dev1.pm1 SetValue 1000',
+    'term1>Dev2.ch3 GetValue',
+    'Dev2 @GetValue 42',
+    'System _ChangedValue 5',
+    'System listnodes',
+    'Dev10 Stop',
+    ' bad message',
+]
+
+def _legacy_parse(buf):
+    """_sendmes parsing as it was before starsutil.parse_message."""
+    fromnode = None
+    m = re.match(r"^([a-zA-Z_0-9.\-]+)>", buf)
+    buf = re.sub(r"^([a-zA-Z_0-9.\-]+)>", '', buf, count=1)
+    if m:
+        fromnode = m.group(1)
+    m = re.match(r"^([a-zA-Z_0-9.\-]+)\s*", buf)
+    buf = re.sub(r"^([a-zA-Z_0-9.\-]+)\s*", '', buf, count=1)
+    if not m:
+        return None
+    tonodes = m.group(1)
+    check = bool(re.match(r"^[^@]", buf))
+    return fromnode, tonodes, tonodes.split('.', 1)[0], buf, check
+
+def _parse(buf):
+    fromnode, tonodes, tonode, buf, kind = starsutil.parse_message(buf)
+    if tonodes is None:
+        return None
+    check = (kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EVENT)
+    return fromnode, tonodes, tonode, buf, check
+
+def measure(func, args_list, seconds=BENCH_SECONDS):
+    """Call func(*args) for every entry of args_list repeatedly and return calls per second."""
+    calls = 0
+    start = time.perf_counter()
+    end = start + seconds
+    now = start
+    while now < end:
+        for args in args_list:
+            func(*args)
+        calls += len(args_list)
+        now = time.perf_counter()
+    return calls / (now - start)
+
+def bench_parse():
+    args_list = [(m,) for m in SAMPLE_MESSAGES]
+    for m in SAMPLE_MESSAGES:
+        if _legacy_parse(m) != _parse(m):
+            raise AssertionError('Parser mismatch for %r' %m)
+    return [('legacy', measure(_legacy_parse, args_list)),
+            ('compiled', measure(_parse, args_list))]
+
+_fixture = {}
+
+def fixture():
+    """Temporary lib directory with TABLE_SIZE entries in every table, created once."""
+    if _fixture:
+        return _fixture
+    libdir = tempfile.mkdtemp(prefix='starsbench-')
+    atexit.register(shutil.rmtree, libdir, True)
+    n = TABLE_SIZE
+    hosts = ['10.%d.%d.%d' %(i // 65536, (i // 256) % 256, i % 256) for i in range(n // 3)]
+    hosts += ['172.%d.0.0/16' %(16 + i % 16) if i < 16 else '10.200.%d.0/24' %i for i in range(n // 3)]
+    hosts += ['host%d.example.org' %i if i % 2 else 'lab%d-*.example.org' %i for i in range(n - len(hosts))]
+    tables = {
+        starsutil.HOSTLIST: hosts + ['localhost'],
+        starsutil.CMDDENY: [r'^term%d>Dev%d SetValue' %(i, i) for i in range(n)],
+        starsutil.CMDALLOW: [r'^term%d>' %i for i in range(n)] + [r'^Dev\d+>'],
+        starsutil.RECONNECTABLEDENY: ['Dev%d 10.0.0.%d' %(i, i % 256) for i in range(n)],
+        starsutil.RECONNECTABLEALLOW: ['term%d' %i for i in range(n)],
+    }
+    for filename, lines in tables.items():
+        with open(os.path.join(libdir, filename), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    for i in range(n):
+        with open(os.path.join(libdir, 'Dev%d.key' %i), 'w') as f:
+            f.write('\n'.join('key%d-%d' %(i, k) for k in range(8)) + '\n')
+    _fixture['libdir'] = libdir
+    _fixture['tables'] = tables
+    return _fixture
+
+def bench_checkhost():
+    libdir = fixture()['libdir']
+    args_list = [(starsutil.HOSTLIST, h, ip, False, libdir) for h, ip in (
+        ('localhost', '127.0.0.1'),
+        ('unknown.example.com', '10.0.0.99'),
+        ('x.example.com', '172.20.1.2'),
+        ('host101.example.org', '192.0.2.1'),
+        ('lab100-7.example.org', '192.0.2.2'),
+        ('denied.example.net', '192.0.2.3'),
+    )]
+    return [('acl', measure(starsutil.system_checkhost, args_list))]
+
+def bench_cmdperm():
+    tables = fixture()['tables']
+    deny, allow = tables[starsutil.CMDDENY], tables[starsutil.CMDALLOW]
+    args_list = [('term%d' %(i * 7 % TABLE_SIZE), 'Dev%d' %i, 'SetValue 1') for i in range(0, TABLE_SIZE, 10)]
+    args_list += [('Dev%d' %i, 'term1', '@GetValue 5') for i in range(10)]
+    def legacy(frm, to, buf):
+        return starsutil.isdenycheckcmd_deny(frm, to, buf, deny) or starsutil.isdenycheckcmd_allow(frm, to, buf, allow)
+    perm = starsutil.CommandPermission(deny, allow)
+    uncached = starsutil.CommandPermission(deny, allow, cachesize=0)
+    for args in args_list:
+        if legacy(*args) != perm.isdenied(*args):
+            raise AssertionError('Command permission mismatch for %r' %(args,))
+    return [('legacy', measure(legacy, args_list, BENCH_SECONDS / 2)),
+            ('compiled', measure(uncached.isdenied, args_list)),
+            ('cached', measure(perm.isdenied, args_list))]
+
+def bench_nodekey():
+    libdir = fixture()['libdir']
+    args_list = [('Dev%d' %i, i, 'key%d-%d' %(i, i % 8), libdir) for i in range(0, TABLE_SIZE, 7)]
+    args_list.append(('Nobody', 1, 'key', libdir))
+    return [('cached', measure(starsutil.check_nodekey, args_list))]
+
+def bench_reconnect():
+    tables = fixture()['tables']
+    deny, allow = tables[starsutil.RECONNECTABLEDENY], tables[starsutil.RECONNECTABLEALLOW]
+    args_list = [('Dev%d' %i, 'localhost', deny, allow) for i in range(0, TABLE_SIZE, 30)]
+    args_list += [('term%d' %i, 'localhost', deny, allow) for i in range(0, TABLE_SIZE, 30)]
+    return [('tables', measure(starsutil.check_reconnecttable, args_list))]
+
+class _NullBuffer:
+    """SendBuffer stand-in that only counts, so nothing piles up while measuring."""
+    __slots__ = ('size',)
+
+    def __init__(self):
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        self.size += len(data)
+
+def bench_event():
+    """Events through the delivery path of the single thread server into counting buffers."""
+    import starskernel
+    server = starskernel.Starsserver(0, fixture()['libdir'], None)
+    for i in range(TABLE_SIZE):
+        conn = starskernel.Connection.__new__(starskernel.Connection)
+        conn.node = 'Dev%d' %i
+        conn.outbuf = _NullBuffer()
+        #Marked as writing, so no select set is touched.
+        conn.flags = starskernel.CONN_WRITING
+        server._node[conn.node] = conn
+        server._node_flgon.add('Dev%d' %i, 'Dev%d.pm%d' %(i * 13 % TABLE_SIZE, i % 4))
+        server._node_flgon.add('Dev%d' %i, 'Dev0')
+    args_list = [('Dev0', '_ChangedValue 1'), ('Dev13.pm1', '_ChangedValue 2'), ('Dev7', '_ChangedIsBusy 0')]
+    fanout = sum(len(server._node_flgon.subscribers(frn)) for frn, _unused in args_list) / len(args_list)
+    rate = measure(server._system_event, args_list)
+    return [('events', rate), ('deliveries', rate * fanout)]
+
+class _Message:
+    """Stand-in for starskernelmp.StarsMessage without importing the server."""
+    def __init__(self, fromnode='', data=''):
+        self._from = fromnode
+        self._data = data
+
+    def get_from(self):
+        return self._from
+
+    def get_data(self):
+        return self._data
+
+def bench_recorder():
+    """Records per second into a small ring file, so it wraps all the time."""
+    recorder = starsrecorder.Recorder(os.path.join(fixture()['libdir'], 'bench.ring'), 1048576, False)
+    args_list = [(starsrecorder.REC_IN, 'Dev1', 'Dev2', buf) for buf in SAMPLE_MESSAGES]
+    args_list.append((starsrecorder.REC_OUT, '', 'Dev2', b'Dev1>Dev2 SetValue ' + b'x' * 1000 + b'\n'))
+    rate = measure(recorder.record, args_list)
+    recorder.close()
+    return [('records', rate)]
+
+def _transport_consumer(channel, count, done):
+    done.put(False)
+    for _unused in range(count):
+        channel.get(block=True)
+    done.put(True)
+
+def _transport_rate(channel, count=TRANSPORT_MESSAGES):
+    """Messages per second from this process to a spawned consumer process through channel."""
+    ctx = mp.get_context('spawn')
+    done = ctx.Queue()
+    consumer = ctx.Process(target=_transport_consumer, args=(channel, count, done))
+    consumer.start()
+    msg = _Message(None, b'Dev1>Dev2.pm1 SetValue 1000\n')
+    done.get()
+    start = time.perf_counter()
+    for _unused in range(count):
+        channel.put(msg)
+    done.get()
+    rate = count / (time.perf_counter() - start)
+    consumer.join()
+    return rate
+
+def bench_transport():
+    results = [('queue', _transport_rate(mp.get_context('spawn').Queue()))]
+    if starsring.HAS_SHM:
+        channel = starsring.RingChannel(_Message)
+        try:
+            results.append(('shmring', _transport_rate(channel)))
+        finally:
+            channel.close()
+    return results
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'checkhost': bench_checkhost,
+    'cmdperm': bench_cmdperm,
+    'nodekey': bench_nodekey,
+    'reconnect': bench_reconnect,
+    'event': bench_event,
+    'recorder': bench_recorder,
+    'transport': bench_transport,
+}
+
+def machine():
+    return '%s %s Python %s' %(platform.node(), platform.machine(), platform.python_version())
+
+def loadbaselines(filename):
+    """Baselines saved on this machine, empty if there are none."""
+    try:
+        with open(filename) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if (not isinstance(saved, dict)) or (saved.get('machine') != machine()):
+        return {}
+    return saved.get('baselines', {})
+
+def main(argv=None):
+    parser = ArgumentParser(description='STARS Server microbenchmarks.')
+    parser.add_argument('names', nargs='*', help='Benchmarks: %s. Default all.' %' '.join(BENCHMARKS))
+    parser.add_argument('-baseline', default=BASELINEFILE, help='JSON file with the baselines.')
+    parser.add_argument('-threshold', type=float, default=THRESHOLD,
+                        help='Allowed slowdown against the baseline as fraction.')
+    parser.add_argument('-save', action='store_true', help='Store the results as baselines.')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: %s (available: %s)' %(name, ' '.join(BENCHMARKS)))
+    baselines = loadbaselines(args.baseline)
+    if (not baselines) and (not args.save):
+        print('No baselines of this machine in %s, results are not compared. Run with -save first.' %args.baseline)
+    regressions = 0
+    for name in args.names or list(BENCHMARKS):
+        for variant, rate in BENCHMARKS[name]():
+            key = '%s.%s' %(name, variant)
+            line = '%-24s %14.0f /s' %(key, rate)
+            if variant in REFERENCE_VARIANTS:
+                print(line + '  reference')
+                sys.stdout.flush()
+                continue
+            base = baselines.get(key)
+            if base and not args.save:
+                change = rate / base - 1.0
+                line += '  %+6.1f%% of baseline' %(change * 100)
+                if change < -args.threshold:
+                    line += '  REGRESSION'
+                    regressions += 1
+            print(line)
+            sys.stdout.flush()
+            if args.save:
+                baselines[key] = round(rate, 1)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine(), 'baselines': baselines}, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print('Baselines written to %s' %args.baseline)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+""" STARS Server lib configuration module.
+
+The command permissions, aliases, reconnectable lists and tap allow list
+of the lib directory are read into an immutable LibConfig. ConfigWatcher polls the
+mtimes of the files in its own thread and builds a new LibConfig when a
+file has been changed, created or deleted, so reading and compiling the
+files never blocks the routing. The server switches to the new tables by
+replacing one reference. Every load starts from empty tables, so removed
+rules and aliases are gone after a reload.
+"""
+
+import os
+import threading
+import starsfile
+import starsutil
+
+CONFIG_INTERVAL = 2.0
+CONFIG_RETRIES = 3
+CONFIGFILES = (starsutil.CMDDENY, starsutil.CMDALLOW, starsutil.ALIASES,
+               starsutil.RECONNECTABLEDENY, starsutil.RECONNECTABLEALLOW, starsutil.TAPALLOW)
+
+class LibConfig:
+    """Tables of one version of the lib files. Not changed after it has been created."""
+    __slots__ = ('cmdperm', 'aliasreal', 'realalias', 'reconndeny', 'reconnallow', 'tapallow', 'stamps')
+
+    def __init__(self, cmddeny=(), cmdallow=(), aliasreal=None, realalias=None,
+                 reconndeny=(), reconnallow=(), tapallow=(), stamps=None):
+        self.cmdperm = starsutil.CommandPermission(cmddeny, cmdallow)
+        self.aliasreal = aliasreal if aliasreal is not None else {}
+        self.realalias = realalias if realalias is not None else {}
+        self.reconndeny = list(reconndeny)
+        self.reconnallow = list(reconnallow)
+        self.tapallow = frozenset(tapallow)
+        self.stamps = stamps
+
+def filestamps(libdir):
+    """(mtime, size) of every configuration file, None for a missing one."""
+    stamps = []
+    for filename in CONFIGFILES:
+        try:
+            st = os.stat(os.path.join(starsutil.SERVERDIR, libdir, filename))
+            stamps.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
+
+def _loadlist(filename, libdir):
+    try:
+        return starsfile.loadfiletolist(filename, starsutil.SERVERDIR, libdir)
+    except FileNotFoundError:
+        return []
+
+def load_libconfig(libdir):
+    """New LibConfig from the files of libdir, a missing file gives an empty table.
+    Raises OSError or ValueError if a file can not be read."""
+    stamps = filestamps(libdir)
+    aliasreal = {}
+    realalias = {}
+    try:
+        starsfile.loadfiletodictionary(starsutil.ALIASES, starsutil.SERVERDIR, libdir, aliasreal, realalias)
+    except FileNotFoundError:
+        pass
+    except IndexError:
+        raise ValueError('Alias without real name in %s.' %starsutil.ALIASES)
+    return LibConfig(_loadlist(starsutil.CMDDENY, libdir), _loadlist(starsutil.CMDALLOW, libdir),
+                     aliasreal, realalias, _loadlist(starsutil.RECONNECTABLEDENY, libdir),
+                     _loadlist(starsutil.RECONNECTABLEALLOW, libdir), _loadlist(starsutil.TAPALLOW, libdir), stamps)
+
+class ConfigWatcher:
+    """Thread that reloads the lib configuration when its files change.
+
+    publish(config) is called in the watcher thread with every new
+    LibConfig. reload(done) asks for a reload now, done(ok) is called when
+    it has been published or has failed. If the files change while they are
+    read, they are read again; a file that can not be read keeps the
+    previous configuration.
+    """
+    def __init__(self, libdir, config, publish, interval=CONFIG_INTERVAL):
+        self._libdir = libdir
+        self._stamps = config.stamps
+        self._publish = publish
+        self._interval = interval
+        self._wakeup = threading.Event()
+        self._waiting = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='Config')
+        thread.daemon = True
+        thread.start()
+
+    def reload(self, done=None):
+        if done is not None:
+            with self._lock:
+                self._waiting.append(done)
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            with self._lock:
+                waiting, self._waiting = self._waiting, []
+            if (not waiting) and (filestamps(self._libdir) == self._stamps):
+                continue
+            ok = self._reload()
+            for done in waiting:
+                try:
+                    done(ok)
+                except Exception as ex:
+                    print('Exception occurred: ', ex)
+
+    def _reload(self):
+        for _unused in range(CONFIG_RETRIES):
+            try:
+                config = load_libconfig(self._libdir)
+            except (OSError, ValueError, UnicodeDecodeError) as ex:
+                print('Can\'t load lib configuration! ', ex)
+                #Reported once, tried again when the files change.
+                self._stamps = filestamps(self._libdir)
+                return False
+            if config.stamps == filestamps(self._libdir):
+                self._stamps = config.stamps
+                self._publish(config)
+                return True
+        #Still being written, the next poll sees the change again.
+        return False
@@ -2,39 +2,95 @@
 import select
 import socket
 import re
+import time
 import random
+from collections import deque
 from PyStars import __version__, __date__
 import starsutil
+import starsmetrics
+import starsrecorder
+import starsconfig
 
 TCP_BUFFER_SIZE = starsutil.get_tcpbuffersize()
 
+#Connection flags
+CONN_WRITING = 0x01
+CONN_CLOSING = 0x02
+CONN_CLOSED = 0x04
+
+class Connection:
+    """State of one client socket. Connection objects are passed to select() directly."""
+    __slots__ = ('sock', 'fd', 'ip', 'host', 'node', 'idkey', 'inbuf', 'outbuf', 'flags')
+
+    def __init__(self, sock, ip, maxline=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.ip = ip
+        self.host = None
+        self.node = None
+        self.idkey = None
+        self.inbuf = starsutil.LineFramer(maxline)
+        self.outbuf = starsutil.SendBuffer()
+        self.flags = 0
+
+    def fileno(self):
+        return self.fd
+
 class Starsserver:
-    def __init__(self, port, lib, key):
+    def __init__(self, port, lib, key, maxline=None, metricsport=None, recorder=None,
+                 recordersize=starsrecorder.RECORDER_SIZE):
         self._port = port
         self._libdir = lib
+        self._maxline = maxline
+        self._metricsport = metricsport
+        self._recorderfile = recorder
+        self._recordersize = recordersize
+        self._recorder = None
         if (key is None) or (key == ''):
             self._keydir = lib
         else:
             self._keydir = key
 
+        self._conn = {}
         self._node = {}
-        self._node_h = {}
-        self._node_flgon = {}
-        self._node_idkey = {}
-        self._aliasreal = {}
-        self._realalias = {}
-
-        self._savebuf = {}
-        self._sockettoclose = []
-        self._readable = []
-        self._writeable = []
-        self._writebuf = {}
-        self._cmddeny = []
-        self._cmdallow = []
-        self._reconndeny = []
-        self._reconnallow = []
+        self._node_flgon = starsutil.FlgonTable()
+        self._taps = {}
+        self._groups = {}
+        self._config = starsconfig.LibConfig()
+        self._configwatcher = None
+
+        self._readable = set()
+        self._writeable = set()
+        self._calls = deque()
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._metrics = starsmetrics.Metrics()
+        self._profiler = starsmetrics.Profiler()
 
     def runserver(self):
+        listener = self._createlistener()
+        if listener is None:
+            return False
+        self._readable.add(listener)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(0)
+        self._wakeup_w.setblocking(0)
+        self._readable.add(self._wakeup_r)
+        self._startmetrics()
+        while True:
+            read, write, _error_unused = select.select(self._readable, self._writeable, [], 2)
+            for conn in read:
+                if conn is listener:
+                    self._acceptnode(conn)
+                elif conn is self._wakeup_r:
+                    self._runcalls()
+                elif not conn.flags & CONN_CLOSED:
+                    self._recvnode(conn)
+            for conn in write:
+                if not conn.flags & CONN_CLOSED:
+                    self._sendnode(conn)
+
+    def _createlistener(self):
         try:
             listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             listener.setblocking(0)
@@ -42,136 +98,260 @@ class Starsserver:
             listener.listen()
         except Exception as ex:
             print('Can\'t create socket for listining! ', ex)
-            return False
-        self._readable.append(listener)
-        while True:
-            read, write, _error_unused = select.select(self._readable, self._writeable, [], 2)
-            for s in read:
-                if s is listener:
-                    new_sock, _unused = s.accept()
-                    new_sock.setblocking(0)
-                    self._readable.append(new_sock)
-                    bufhn, ipadr = starsutil.system_gethostname_or_ip(new_sock)
-                    if not starsutil.system_checkhost(starsutil.get_hostlist(), bufhn, ipadr, False, self._libdir):
-                        self._add_to_send(new_sock, "Bad host. %s\n" %bufhn)
-                        self._readable.remove(new_sock)
-                        self._sockettoclose.append(new_sock)
-                        continue
-                    self._savebuf[new_sock] = ''
-                    self._node_idkey[new_sock] = starsutil.get_nodeidkey()
-                    self._add_to_send(new_sock, "%s\n" %self._node_idkey[new_sock])
-                else:
-                    #To handle large data
-                    datafragments = []
-                    try:
-                        while True:
-                            datapiece = s.recv(TCP_BUFFER_SIZE).decode("utf8")
-                            if not datapiece:
-                                break
-                            datafragments.append(datapiece)
-                    except:
-                        #Ignore the exception!
-                        pass
-                    data = ''.join(datafragments)
-                    if (len(self._savebuf[s]) != 0):
-                        data = self._savebuf[s] + data
-                        self._savebuf[s] = ''
-                    if (len(data) != 0):
-                        m = re.split(r"\r*\n", data)
-                        if '' in m:
-                            m.remove('')
-                        else:
-                            self._savebuf[s] = m[-1]
-                            del m[-1]
-                        for buf in m:
-                            if re.match(r"(?i)^(exit|quit)", buf):
-                                self._delnode(s)
-                                self._readable.remove(s)
-                                if s in self._writeable:
-                                    self._writeable.remove(s)
-                                    del self._writebuf[s]
-                                s.close()
-                                break
-                            elif s in self._node_h:
-                                self._sendmes(s, buf)
-                            else:
-                                if not self._addnode(s, buf):
-                                    del self._node_idkey[s]
-                                    self._readable.remove(s)
-                                    if s in self._writeable:
-                                        self._writeable.remove(s)
-                                        del self._writebuf[s]
-                                    s.close()
-                                    break
-                    else:
-                        self._delnode(s)
-                        self._readable.remove(s)
-                        if s in self._writeable:
-                            self._writeable.remove(s)
-                            del self._writebuf[s]
-                        s.close()
-            for s in write:
-                if self._printh(s):
-                    self._writeable.remove(s)
-                    del self._writebuf[s]
-                    for sock in self._sockettoclose:
-                        sock.close()
-                    self._sockettoclose.clear()
-
-    def _add_to_send(self, xfh, xbuf):
-        if xfh not in self._writeable:
-            self._writeable.append(xfh)
-            self._writebuf[xfh] = ''
-        self._writebuf[xfh] += xbuf
-        if 'Debugger' in self._node:
-            handle = self._node['Debugger']
-            if handle not in self._writeable:
-                self._writeable.append(handle)
-                self._writebuf[handle] = ''
-            self._writebuf[handle] += xbuf
-
-    def _printh(self, xfh):
+            return None
+        return listener
+
+    def _startmetrics(self):
+        if self._metricsport:
+            starsmetrics.MetricsEndpoint(self._metricsport, self._metricstext).start()
+
+    def _metricstext(self):
+        #Called from the endpoint thread, the text is built in the server loop.
+        text = starsmetrics.callinloop(self._callsoon,
+            lambda: self._metrics.exposition(self._gauges(), self._nodegauges()))
+        return text or ''
+
+    def _gauges(self):
+        pending = [len(conn.outbuf) for conn in self._conn.values()]
+        return {'nodes': len(self._node), 'connections': len(self._conn),
+                'pending_bytes': sum(pending), 'pending_bytes_max': max(pending, default=0)}
+
+    def _nodegauges(self):
+        return {'pending_bytes': {node: len(conn.outbuf) for node, conn in self._node.items()}}
+
+    def _nodepending(self, node):
+        conn = self._node.get(node)
+        return len(conn.outbuf) if conn is not None else '-'
+
+    def _callsoon(self, func, *args):
+        """Run func(*args) in the server loop. May be called from other threads."""
+        self._calls.append((func, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            pass
+
+    def _runcalls(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+
+    def _acceptnode(self, listener):
+        new_sock, peer = listener.accept()
+        new_sock.setblocking(0)
+        conn = Connection(new_sock, peer[0], self._maxline)
+        self._conn[conn.fd] = conn
+        bufhn = starsutil.lookup_hostname(conn.ip, lambda host: self._callsoon(self._starthandshake, conn, host))
+        if bufhn is not None:
+            self._starthandshake(conn, bufhn)
+
+    def _starthandshake(self, conn, bufhn):
+        if conn.flags & CONN_CLOSED:
+            return
+        conn.host = bufhn
+        if not starsutil.system_checkhost(starsutil.get_hostlist(), bufhn, conn.ip, False, self._libdir):
+            self._metrics.handshake_failed += 1
+            self._add_to_send(conn, "Bad host. %s\n" %bufhn)
+            self._closelater(conn)
+            return
+        self._watch_read(conn)
+        conn.idkey = starsutil.get_nodeidkey()
+        self._add_to_send(conn, "%s\n" %conn.idkey)
+
+    def _recvnode(self, conn):
         try:
-            buf = (self._writebuf[xfh]).encode()
-            if len(buf) == 0:
+            data = conn.sock.recv(TCP_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._closenode(conn)
+            return
+        metrics = self._metrics
+        metrics.bytes_in += len(data)
+        try:
+            lines = conn.inbuf.feed(data)
+        except starsutil.LineTooLongError as ex:
+            print('Connection closed: ', conn.node, ex)
+            self._closenode(conn)
+            return
+        for buf in lines:
+            if re.match(r"(?i)^(exit|quit)", buf):
+                self._closenode(conn)
+                break
+            elif conn.node is not None:
+                metrics.msgs_in += 1
+                metrics.node_in[conn.node] += 1
+                start = time.perf_counter()
+                self._sendmes(conn, buf)
+                metrics.route.add(time.perf_counter() - start)
+                if conn.flags & CONN_CLOSED:
+                    break
+            else:
+                if not self._addnode(conn, buf):
+                    metrics.handshake_failed += 1
+                    self._closelater(conn)
+                    break
+                metrics.handshakes += 1
+
+    def _sendnode(self, conn):
+        if self._printh(conn):
+            self._unwatch_write(conn)
+            conn.flags &= ~CONN_WRITING
+            if conn.flags & CONN_CLOSING:
+                self._closenode(conn)
+
+    def _closelater(self, conn):
+        """Stop reading from conn and close it as soon as the pending output is sent."""
+        conn.flags |= CONN_CLOSING
+        self._unwatch_read(conn)
+        if not conn.flags & CONN_WRITING:
+            self._closenode(conn)
+
+    def _closenode(self, conn):
+        if conn.flags & CONN_CLOSED:
+            return
+        self._delnode(conn)
+        self._unwatch_read(conn)
+        if conn.flags & CONN_WRITING:
+            self._unwatch_write(conn)
+        conn.flags = CONN_CLOSED
+        conn.outbuf.clear()
+        del self._conn[conn.fd]
+        conn.sock.close()
+
+    def _watch_read(self, conn):
+        self._readable.add(conn)
+
+    def _unwatch_read(self, conn):
+        self._readable.discard(conn)
+
+    def _watch_write(self, conn):
+        self._writeable.add(conn)
+
+    def _unwatch_write(self, conn):
+        self._writeable.discard(conn)
+
+    def _add_to_send(self, conn, xbuf):
+        data = xbuf.encode()
+        self._enqueue(conn, data)
+        if self._taps:
+            self._copytotaps(conn, xbuf, data)
+
+    def _enqueue(self, conn, data):
+        metrics = self._metrics
+        metrics.msgs_out += 1
+        metrics.bytes_out += len(data)
+        if conn.node is not None:
+            metrics.node_out[conn.node] += 1
+        if self._recorder is not None:
+            self._recorder.record(starsrecorder.REC_OUT, '', conn.node or '', data)
+        self._append(conn, data)
+
+    def _append(self, conn, data):
+        if not conn.flags & (CONN_WRITING | CONN_CLOSED):
+            self._watch_write(conn)
+            conn.flags |= CONN_WRITING
+        conn.outbuf.append(data)
+
+    def _copytotaps(self, conn, xbuf, data):
+        """Copies data to the taps whose filter matches. A tap with a full buffer misses the line."""
+        for tap in self._taps.values():
+            tconn = self._node.get(tap.node)
+            if (tconn is None) or (tconn is conn) or not tap.matches(xbuf):
+                continue
+            if len(tconn.outbuf) >= starsutil.TAP_BUFFER_SIZE:
+                tap.dropped += 1
+                self._metrics.tap_dropped += 1
+                continue
+            tap.copied += 1
+            self._append(tconn, data)
+
+    def _printh(self, conn):
+        try:
+            if len(conn.outbuf) == 0:
                 return True
-            send = xfh.send(buf)
-            self._writebuf[xfh] = (buf[send:]).decode()
-            return False
+            conn.outbuf.send(conn.sock)
+            return len(conn.outbuf) == 0
         except Exception:
             return False
 
-    def _sendmes(self, handle, buf):
-        fromnode = fromnodes = self._node_h[handle]
-        m = re.match(r"^([a-zA-Z_0-9.\-]+)>", buf)
-        buf = re.sub(r"^([a-zA-Z_0-9.\-]+)>", '', buf, count=1)
-        if m:
-            fromnode = m.group(1)
-        m = re.match(r"^([a-zA-Z_0-9.\-]+)\s*", buf)
-        buf = re.sub(r"^([a-zA-Z_0-9.\-]+)\s*", '', buf, count=1)
-        if not m:
-            self._add_to_send(handle, "System>%s> @\n" %fromnode)
+    def _sendmes(self, conn, buf):
+        fromnode = fromnodes = conn.node
+        fromover, tonodes, tonode, buf, kind = starsutil.parse_message(buf)
+        if fromover is not None:
+            fromnode = fromover
+        if self._recorder is not None:
+            self._recorder.record(starsrecorder.REC_IN, fromnode, tonodes or '', buf)
+        if tonodes is None:
+            self._add_to_send(conn, "System>%s> @\n" %fromnode)
             return
-        tonodes = m.group(1)
-        if tonodes in self._aliasreal:
-            tonodes = self._aliasreal[tonodes]
-        if (re.match(r"^[^@]", buf)) and (((self._cmddeny) and (starsutil.isdenycheckcmd_deny(fromnodes, tonodes, buf, self._cmddeny)))\
-            or ((self._cmdallow) and (starsutil.isdenycheckcmd_allow(fromnodes, tonodes, buf, self._cmdallow)))):
-            if re.match(r"^[^_]", buf):
-                self._add_to_send(handle, "System>%s @%s Er: Command denied.\n" %(fromnode, buf))
+        config = self._config
+        if tonodes in config.aliasreal:
+            tonodes = config.aliasreal[tonodes]
+            tonode = tonodes.split('.', 1)[0]
+        if (tonode in self._groups) and (tonode not in self._node):
+            #Checked per member by _sendgroup().
+            return self._sendgroup(conn, fromnode, tonodes, self._groups[tonode], buf, kind)
+        if ((kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EVENT))\
+            and config.cmdperm.isdenied(fromnodes, tonodes, buf):
+            self._metrics.denied += 1
+            if kind == starsutil.MSG_COMMAND:
+                self._add_to_send(conn, "System>%s @%s Er: Command denied.\n" %(fromnode, buf))
             return
-        tonode = tonodes
-        tonode = tonode.split('.', 1)[0]
         if tonode == 'System':
-            return self._system_commands(handle, fromnode, buf)
+            return self._system_commands(conn, fromnode, buf)
         if not tonode in self._node:
-            if not re.match(r"^[_@]", buf):
-                self._add_to_send(handle, "System>%s @%s Er: %s is down.\n" %(fromnode, buf, tonode))
+            if (kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EMPTY):
+                self._add_to_send(conn, "System>%s @%s Er: %s is down.\n" %(fromnode, buf, tonode))
             return
-        if fromnode in self._realalias:
-            fromnode = self._realalias[fromnode]
-        tonodeh = self._node[tonode]
-        self._add_to_send(tonodeh, "%s>%s %s\n" %(fromnode, tonodes, buf))
+        if fromnode in config.realalias:
+            fromnode = config.realalias[fromnode]
+        self._add_to_send(self._node[tonode], "%s>%s %s\n" %(fromnode, tonodes, buf))
+
+    def _sendgroup(self, conn, fromnode, tonodes, members, buf, kind):
+        """Every member receives the line with its own name as the receiver, as if it
+        had been sent to it directly. The command permissions are checked per member.
+        The parts before and after the member name are encoded once and shared by the
+        output buffers of all members."""
+        config = self._config
+        if (kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EVENT):
+            members, denied = config.cmdperm.splitmembers(conn.node, tonodes, members, buf)
+            if denied:
+                self._metrics.denied += len(denied)
+                if kind == starsutil.MSG_COMMAND:
+                    for member in denied:
+                        self._add_to_send(conn, "System>%s @%s Er: Command denied for %s.\n" %(fromnode, buf, member))
+        frm = config.realalias.get(fromnode, fromnode)
+        suffix = tonodes[len(tonodes.split('.', 1)[0]):]
+        head = ("%s>" %frm).encode()
+        tail = ("%s %s\n" %(suffix, buf)).encode()
+        size = len(head) + len(tail)
+        metrics = self._metrics
+        recorder = self._recorder
+        for member in members:
+            mconn = self._node.get(member)
+            if mconn is None:
+                if (kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EMPTY):
+                    self._add_to_send(conn, "System>%s @%s Er: %s is down.\n" %(fromnode, buf, member))
+                continue
+            name = member.encode()
+            metrics.msgs_out += 1
+            metrics.bytes_out += size + len(name)
+            metrics.node_out[member] += 1
+            if recorder is not None:
+                recorder.record(starsrecorder.REC_OUT, '', member, head + name + tail[:starsrecorder.RECORD_BODY], size + len(name))
+            self._append(mconn, head)
+            mconn.outbuf.append(name)
+            mconn.outbuf.append(tail)
+            if self._taps:
+                self._copytotaps(mconn, "%s>%s%s %s\n" %(frm, member, suffix, buf), head + name + tail)
 
     def _system_commands(self, hd, frn, cmd):
         if cmd.startswith('_'):
@@ -186,18 +366,38 @@ class Starsserver:
             cmd = cmd.replace('flgoff ', '')
             self._system_flgoff(hd, frn, cmd)
         elif cmd == 'loadreconnectablepermission':
-            starsutil.system_loadreconnecttablepermission(self._libdir, self._reconndeny, self._reconnallow)
-            self._add_to_send(hd, "System>%s @loadreconnectablepermission Reconnectable permission list has been loaded.\n" %frn)
+            self._system_reload(hd, frn, cmd, 'Reconnectable permission list has been loaded.')
         elif cmd == 'loadpermission':
-            starsutil.system_loadcommandpermission(self._libdir, self._cmddeny, self._cmdallow)
-            self._add_to_send(hd, "System>%s @loadpermission Command permission list has been loaded.\n" %frn)
+            self._system_reload(hd, frn, cmd, 'Command permission list has been loaded.')
+        elif cmd == 'loadkeys':
+            starsutil.system_loadkeys()
+            self._add_to_send(hd, "System>%s @loadkeys Key files will be reloaded.\n" %frn)
         elif cmd == 'loadaliases':
-            starsutil.system_loadaliases(self._libdir, self._aliasreal, self._realalias)
-            self._add_to_send(hd, "System>%s @loadaliases Aliases has been loaded.\n" %frn)
+            self._system_reload(hd, frn, cmd, 'Aliases has been loaded.')
         elif cmd == 'listaliases':
-            self._add_to_send(hd, "System>%s @listaliases %s\n" %(frn, starsutil.system_listaliases(self._aliasreal)))
+            self._add_to_send(hd, "System>%s @listaliases %s\n" %(frn, starsutil.system_listaliases(self._config.aliasreal)))
+        elif re.match(r"groupdef ", cmd):
+            self._system_groupdef(hd, frn, cmd[9:])
+        elif re.match(r"groupdel ", cmd):
+            self._system_groupdel(hd, frn, cmd[9:])
+        elif cmd == 'listgroups':
+            self._add_to_send(hd, "System>%s @listgroups %s\n" %(frn, starsutil.system_listgroups(self._groups)))
         elif cmd == 'listnodes':
             self._add_to_send(hd, "System>%s @listnodes %s\n" %(frn, starsutil.system_listnodes(self._node)))
+        elif cmd == 'stats':
+            self._add_to_send(hd, "System>%s @stats %s\n" %(frn, self._metrics.summary(self._gauges())))
+        elif re.match(r"stats ", cmd):
+            cmd = cmd.replace('stats ', '')
+            self._system_stats(hd, frn, cmd)
+        elif re.match(r"profile ", cmd):
+            cmd = cmd.replace('profile ', '')
+            self._system_profile(hd, frn, cmd)
+        elif (cmd == 'tap') or re.match(r"tap ", cmd):
+            self._system_tap(hd, frn, cmd[4:])
+        elif cmd == 'untap':
+            self._system_untap(hd, frn)
+        elif cmd == 'listtaps':
+            self._add_to_send(hd, "System>%s @listtaps %s\n" %(frn, ', '.join(tap.summary() for tap in self._taps.values())))
         elif cmd == 'getversion':
             self._add_to_send(hd, "System>%s @getversion Version: %s Date: %s\n" %(frn, __version__, __date__))
         elif cmd == 'gettime':
@@ -205,7 +405,7 @@ class Starsserver:
         elif cmd == 'hello':
             self._add_to_send(hd, "System>%s @hello Nice to meet you.\n" %frn)
         elif cmd == 'help':
-            self._add_to_send(hd, "System>%s @help flgon flgoff loadaliases listaliases loadpermission loadreconnectablepermission listnodes getversion gettime hello disconnect\n" %frn)
+            self._add_to_send(hd, "System>%s @help flgon flgoff loadaliases listaliases loadpermission loadreconnectablepermission loadkeys groupdef groupdel listgroups listnodes stats profile tap untap listtaps getversion gettime hello disconnect\n" %frn)
         elif cmd.startswith('@'):
             return True
         else:
@@ -213,47 +413,152 @@ class Starsserver:
         return True
 
     def _system_event(self, frn, cmd):
-        to = None
-        topre = None
-        if frn in self._realalias:
-            frn = self._realalias[frn]
-        for key in self._node_flgon:
-            if re.search(frn, self._node_flgon[key]):
-                to = topre = key
-                topre = topre.split('.', 1)[0]
-                buffh = self._node[topre]
-                self._add_to_send(buffh, "%s>%s %s\n" %(frn, to, cmd))
+        frn = self._config.realalias.get(frn, frn)
+        self._sendevent(frn, self._node_flgon.targets(frn), cmd)
+
+    def _sendevent(self, node, targets, event):
+        """Sends "node>subscriber event" to the (node, subscriber, encoded subscriber)
+        targets. The line is rendered once as bytes before and after the subscriber
+        name, every receiver only queues references to them."""
+        head = ("%s>" %node).encode()
+        tail = (" %s\n" %event).encode()
+        size = len(head) + len(tail)
+        nodes = self._node
+        metrics = self._metrics
+        node_out = metrics.node_out
+        recorder = self._recorder
+        count = nbytes = 0
+        for topre, key, name in targets:
+            tconn = nodes.get(topre)
+            if tconn is None:
+                continue
+            count += 1
+            nbytes += size + len(name)
+            node_out[topre] += 1
+            if recorder is not None:
+                recorder.record(starsrecorder.REC_OUT, '', topre, head + name + tail[:starsrecorder.RECORD_BODY], size + len(name))
+            if not tconn.flags & (CONN_WRITING | CONN_CLOSED):
+                self._watch_write(tconn)
+                tconn.flags |= CONN_WRITING
+            outbuf = tconn.outbuf
+            outbuf.append(head)
+            outbuf.append(name)
+            outbuf.append(tail)
+            if self._taps:
+                self._copytotaps(tconn, "%s>%s %s\n" %(node, key, event), head + name + tail)
+        metrics.msgs_out += count
+        metrics.bytes_out += nbytes
 
     def _system_disconnect(self, hd, frn, cmd):
         if not re.match(r"^([a-zA-Z_0-9.\-]+)", cmd):
             self._add_to_send(hd, "System>%s @disconnect Er: Parameter is not enough.\n" %frn)
             return False
-        if cmd in self._aliasreal:
-            cmd = self._aliasreal[cmd]
+        cmd = self._config.aliasreal.get(cmd, cmd)
         if not cmd in self._node:
             self._add_to_send(hd, "System>%s @disconnect Er: Node %s is down.\n" %(frn, cmd))
             return False
-        dhandle = self._node[cmd]
         self._add_to_send(hd, "System>%s @disconnect %s.\n" %(frn, cmd))
-        self._delnode(dhandle)
-        self._readable.remove(dhandle)
-        if dhandle in self._writeable:
-            self._writeable.remove(dhandle)
-        dhandle.close()
+        self._closenode(self._node[cmd])
+        return True
+
+    def _system_reload(self, hd, frn, cmd, text):
+        """The lib files are read by the config watcher, the answer is sent when the new tables are used."""
+        def done(ok):
+            if ok:
+                self._callsoon(self._reply, hd, "System>%s @%s %s\n" %(frn, cmd, text))
+            else:
+                self._callsoon(self._reply, hd, "System>%s @%s Er: Lib files can not be loaded.\n" %(frn, cmd))
+        self._configwatcher.reload(done)
+        return True
+
+    def _reply(self, conn, xbuf):
+        if not conn.flags & CONN_CLOSED:
+            self._add_to_send(conn, xbuf)
+
+    def _setconfig(self, config):
+        #Called by the config watcher thread, the router picks it up with its next line.
+        self._config = config
+        print('Lib configuration has been loaded. Time:', time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+
+    def _system_groupdef(self, hd, frn, cmd):
+        error = starsutil.system_groupdef(self._groups, cmd, self._node, self._config.aliasreal)
+        if error is not None:
+            self._add_to_send(hd, "System>%s @groupdef Er: %s\n" %(frn, error))
+            return False
+        name = cmd.split()[0]
+        self._add_to_send(hd, "System>%s @groupdef Group %s has been defined: %s.\n" %(frn, name, ' '.join(self._groups[name])))
+        return True
+
+    def _system_groupdel(self, hd, frn, cmd):
+        if self._groups.pop(cmd.strip(), None) is None:
+            self._add_to_send(hd, "System>%s @groupdel Er: Group %s is not defined.\n" %(frn, cmd.strip()))
+            return False
+        self._add_to_send(hd, "System>%s @groupdel Group %s has been removed.\n" %(frn, cmd.strip()))
+        return True
+
+    def _system_stats(self, hd, frn, cmd):
+        stats = []
+        for node in cmd.split():
+            node = self._config.aliasreal.get(node, node)
+            stats.append(self._metrics.nodesummary(node, self._nodepending(node)))
+        self._add_to_send(hd, "System>%s @stats %s\n" %(frn, ', '.join(stats)))
+        return True
+
+    def _system_profile(self, hd, frn, cmd):
+        if cmd == 'start':
+            if not self._profiler.start():
+                self._add_to_send(hd, "System>%s @profile Er: Profiler is already running.\n" %frn)
+                return False
+            self._add_to_send(hd, "System>%s @profile Profiler has been started.\n" %frn)
+        elif cmd == 'stop':
+            if not self._profiler.stop():
+                self._add_to_send(hd, "System>%s @profile Er: Profiler is not running.\n" %frn)
+                return False
+            self._add_to_send(hd, "System>%s @profile Profiler has been stopped.\n" %frn)
+        elif cmd == 'dump':
+            try:
+                name = self._profiler.dump(self._libdir)
+            except Exception as ex:
+                self._add_to_send(hd, "System>%s @profile Er: %s\n" %(frn, ex))
+                return False
+            if name is None:
+                self._add_to_send(hd, "System>%s @profile Er: Profiler has not been started.\n" %frn)
+                return False
+            self._add_to_send(hd, "System>%s @profile Stats have been written to %s.prof and %s.txt.\n" %(frn, name, name))
+        else:
+            self._add_to_send(hd, "System>%s @profile Er: Parameter must be start, stop or dump.\n" %frn)
+            return False
+        return True
+
+    def _system_tap(self, hd, frn, cmd):
+        node = hd.node
+        if not starsutil.isallowedtap(node, self._config.tapallow):
+            self._add_to_send(hd, "System>%s @tap Er: Tap is not allowed for %s.\n" %(frn, node))
+            return False
+        try:
+            tap = starsutil.Tap(node, *cmd.split()[:3])
+        except ValueError as ex:
+            self._add_to_send(hd, "System>%s @tap Er: Bad filter, %s.\n" %(frn, ex))
+            return False
+        self._taps[node] = tap
+        self._add_to_send(hd, "System>%s @tap Tap %s has been registered.\n" %(frn, tap.spec))
+        return True
+
+    def _system_untap(self, hd, frn):
+        if self._taps.pop(hd.node, None) is None:
+            self._add_to_send(hd, "System>%s @untap Er: No tap registered.\n" %frn)
+            return False
+        self._add_to_send(hd, "System>%s @untap Tap has been removed.\n" %frn)
         return True
 
     def _system_flgon(self, hd, frn, cmd):
         if not re.match(r"^([a-zA-Z_0-9.\-]+)", cmd):
             self._add_to_send(hd, "System>%s @flgon Er: Parameter is not enough.\n" %frn)
             return False
-        if frn in self._node_flgon:
-            if (re.findall(cmd, self._node_flgon[frn])):
-                self._add_to_send(hd, "System>%s @flgon Er: Node %s is allready in the list.\n" %(frn, cmd))
-                return False
-            self._node_flgon[frn] += ' ' + cmd
-            self._add_to_send(hd, "System>%s @flgon Node %s has been registered.\n" %(frn, cmd))
-            return True
-        self._node_flgon[frn] = cmd
+        added = [name for name in cmd.split() if self._node_flgon.add(frn, name)]
+        if not added:
+            self._add_to_send(hd, "System>%s @flgon Er: Node %s is allready in the list.\n" %(frn, cmd))
+            return False
         self._add_to_send(hd, "System>%s @flgon Node %s has been registered.\n" %(frn, cmd))
         return True
 
@@ -261,88 +566,74 @@ class Starsserver:
         if not re.match(r"^([a-zA-Z_0-9.\-]+)", cmd):
             self._add_to_send(hd, "System>%s @flgoff Er: Parameter is not enough.\n" %frn)
             return False
-        if frn in self._node_flgon:
-            if (re.findall(cmd, self._node_flgon[frn])):
-                self._node_flgon[frn] = self._node_flgon[frn].replace(cmd, '').lstrip()
-                self._add_to_send(hd, "System>%s @flgoff Node %s has been removed.\n" %(frn, cmd))
-                return True
-            else:
-                self._add_to_send(hd, "System>%s @flgoff Er: Node %s is not in the list.\n" %(frn, cmd))
-                return False
-        else:
+        if frn not in self._node_flgon:
             self._add_to_send(hd, "System>%s @flgoff Er: List is void.\n" %frn)
             return False
+        removed = [name for name in cmd.split() if self._node_flgon.remove(frn, name)]
+        if not removed:
+            self._add_to_send(hd, "System>%s @flgoff Er: Node %s is not in the list.\n" %(frn, cmd))
+            return False
+        self._add_to_send(hd, "System>%s @flgoff Node %s has been removed.\n" %(frn, cmd))
+        return True
 
     def _disconnect_for_reconnect(self, node):
-        cmd = node
-        dhandle = self._node[cmd]
-        self._delnode(dhandle)
-        self._readable.remove(dhandle)
-        if dhandle in self._writeable:
-            self._writeable.remove(dhandle)
-        dhandle.close()
+        self._closenode(self._node[node])
         return True
 
-    def _addnode(self, handle, buff):
+    def _addnode(self, conn, buff):
         try:
             node, idmess = buff.split(' ')
         except Exception:
             return False
         reconnectflag = False
         if node in self._node:
-            if not starsutil.check_reconnecttable(node, handle, self._reconndeny, self._reconnallow):
-                self._add_to_send(handle, "System> Er: %s already exists.\n" %node)
+            if not starsutil.check_reconnecttable(node, conn.host, self._config.reconndeny, self._config.reconnallow):
+                self._add_to_send(conn, "System> Er: %s already exists.\n" %node)
                 return False
             else:
                 reconnectflag = True
-        if not starsutil.check_term_and_host(node, handle, self._libdir):
-            self._add_to_send(handle, "System> Er: Bad host for %s\n" %node)
+        if not starsutil.check_term_and_host(node, conn.host, conn.ip, self._libdir):
+            self._add_to_send(conn, "System> Er: Bad host for %s\n" %node)
             return False
-        if not starsutil.check_nodekey(node, self._node_idkey[handle], idmess, self._keydir):
-            self._add_to_send(handle, "System> Er: Bad node name or key\n")
+        if not starsutil.check_nodekey(node, conn.idkey, idmess, self._keydir):
+            self._add_to_send(conn, "System> Er: Bad node name or key\n")
             return False
         if reconnectflag:
             self._disconnect_for_reconnect(node)
-        self._node[node] = handle
-        self._node_h[handle] = node
-        self._add_to_send(handle, "System>%s Ok:\n" %node)
-        if node in self._realalias:
-            node = self._realalias[node]
-        for key in self._node_flgon:
-            if re.search(node, self._node_flgon[key]):
-                topre = key
-                topre = topre.split('.', 1)[0]
-                buffh = self._node[topre]
-                self._add_to_send(buffh, "%s>%s _Connected\n" %(node, key))
+        self._node[node] = conn
+        conn.node = node
+        if node == starsutil.DEBUGGER_NODE:
+            #Debugger gets every line, as before taps existed.
+            self._taps[node] = starsutil.Tap(node)
+        self._add_to_send(conn, "System>%s Ok:\n" %node)
+        node = self._config.realalias.get(node, node)
+        self._sendevent(node, self._node_flgon.nodetargets(node), '_Connected')
         return True
 
-    def _delnode(self, handle):
+    def _delnode(self, conn):
         try:
-            topre = None
-            node = self._node_h.get(handle)
+            node = conn.node
             if node is None:
                 return
-            del self._node_h[handle]
+            conn.node = None
             del self._node[node]
-            del self._node_idkey[handle]
-            for key in list(self._node_flgon.keys()):
-                if re.findall(r"%s($|.)" %node, key):
-                    del self._node_flgon[key]
-            if node in self._realalias:
-                node = self._realalias[node]
-            for key in self._node_flgon:
-                if re.search(node, self._node_flgon[key]):
-                    topre = key
-                    topre = topre.split('.', 1)[0]
-                    buffh = self._node[topre]
-                    self._add_to_send(buffh, "%s>%s _Disconnected\n" %(node, key))
+            self._taps.pop(node, None)
+            self._node_flgon.dropnode(node)
+            node = self._config.realalias.get(node, node)
+            self._sendevent(node, self._node_flgon.nodetargets(node), '_Disconnected')
         except Exception as ex:
             print('Exception occurred: ', ex)
 
     def startup(self):
         initialized = True
         random.seed()
-        initialized = starsutil.system_loadcommandpermission(self._libdir, self._cmddeny, self._cmdallow)
-        initialized = starsutil.system_loadaliases(self._libdir, self._aliasreal, self._realalias)
-        initialized = starsutil.system_loadreconnecttablepermission(self._libdir, self._reconndeny, self._reconnallow)
+        try:
+            self._config = starsconfig.load_libconfig(self._libdir)
+        except (OSError, ValueError, UnicodeDecodeError) as ex:
+            print('Can\'t load lib configuration! ', ex)
+            initialized = False
+        self._configwatcher = starsconfig.ConfigWatcher(self._libdir, self._config, self._setconfig)
+        self._configwatcher.start()
+        #Only the server loop records.
+        self._recorder = starsrecorder.open_recorder(self._recorderfile, self._libdir, self._recordersize, False)
         return initialized
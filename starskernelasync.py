@@ -0,0 +1,69 @@
+""" STARS Server asyncio module.
+
+Same routing as the single thread server, but the sockets are registered
+once with the asyncio event loop (epoll/kqueue where available) instead of
+being passed to select() on every iteration.
+"""
+import asyncio
+import socket
+import starskernel
+import starsrecorder
+
+class Starsserver(starskernel.Starsserver):
+    def __init__(self, port, lib, key, maxline=None, metricsport=None, recorder=None,
+                 recordersize=starsrecorder.RECORDER_SIZE):
+        super(Starsserver, self).__init__(port, lib, key, maxline, metricsport, recorder, recordersize)
+        self._loop = None
+
+    def runserver(self):
+        listener = self._createlistener()
+        if listener is None:
+            return False
+        #Selector loop is required for add_reader/add_writer (Proactor on Windows does not support them).
+        self._loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.add_reader(listener.fileno(), self._acceptall, listener)
+        self._startmetrics()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.remove_reader(listener.fileno())
+            listener.close()
+            self._loop.close()
+
+    def _createlistener(self):
+        try:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setblocking(0)
+            listener.bind(('', self._port))
+            listener.listen(socket.SOMAXCONN)
+        except Exception as ex:
+            print('Can\'t create socket for listining! ', ex)
+            return None
+        return listener
+
+    def _acceptall(self, listener):
+        #Drain the backlog at once to handle reconnection storms.
+        while True:
+            try:
+                self._acceptnode(listener)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                print('Exception occurred: ', ex)
+                return
+
+    def _callsoon(self, func, *args):
+        self._loop.call_soon_threadsafe(func, *args)
+
+    def _watch_read(self, conn):
+        self._loop.add_reader(conn.fd, self._recvnode, conn)
+
+    def _unwatch_read(self, conn):
+        self._loop.remove_reader(conn.fd)
+
+    def _watch_write(self, conn):
+        self._loop.add_writer(conn.fd, self._sendnode, conn)
+
+    def _unwatch_write(self, conn):
+        self._loop.remove_writer(conn.fd)
@@ -1,20 +1,43 @@
 """ STARS Server multiprocessing module. """
 
+import os
 import socket
+import selectors
 import time
 import re
+import queue
+from collections import deque
 import random
 import threading
 import multiprocessing as mp
+from multiprocessing import connection as mp_connection
 from PyStars import __version__, __date__
 import starsutil
+import starsring
+import starsmetrics
+import starsrecorder
+import starsconfig
 
 TCP_BUFFER_SIZE = starsutil.get_tcpbuffersize()
+SEND_GATHER_BYTES = 65536
+HANDSHAKE_TIMEOUT = 10.0
+MSG_BATCH = 256
+OVERFLOW_SIZE = 4194304
+OVERFLOW_WAIT = 0.005
 
 class StarsMessage:
-    def __init__(self, fromnode='', data=''):
+    """Message between the processes. data is one line, a list of lines
+    received at once or the encoded lines to send."""
+    __slots__ = ('_from', '_data', '_connid')
+
+    def __init__(self, fromnode='', data='', connid=None):
         self._from = fromnode
         self._data = data
+        self._connid = connid
+
+    def __reduce__(self):
+        #Pickled as a plain tuple of the arguments.
+        return (StarsMessage, (self._from, self._data, self._connid))
 
     def get_from(self):
         return self._from
@@ -22,13 +45,38 @@ class StarsMessage:
     def get_data(self):
         return self._data
 
+    def get_connid(self):
+        return self._connid
+
+class Handshake:
+    """Login of one connection that is not yet a node."""
+    __slots__ = ('sock', 'ip', 'host', 'nodekey', 'framer', 'started', 'deadline')
+
+    def __init__(self, sock, ip, maxline=None):
+        self.sock = sock
+        self.ip = ip
+        self.host = None
+        self.nodekey = None
+        self.framer = starsutil.LineFramer(maxline)
+        self.started = time.monotonic()
+        self.deadline = self.started + HANDSHAKE_TIMEOUT
+
+class Overflow:
+    """Data for a node whose ring was full, sent before any newer data."""
+    __slots__ = ('chunks', 'size')
+
+    def __init__(self):
+        self.chunks = deque()
+        self.size = 0
+
 class SendRecvProcess(mp.Process):
-    def __init__(self, nodename, sock, recv_q, send_q):
+    def __init__(self, nodename, sock, recv_q, send_q, maxline=None):
         super(SendRecvProcess, self).__init__()
         self._mynodename = nodename
         self._sock = sock
         self._recv_q = recv_q
         self._send_q = send_q
+        self._maxline = maxline
         self._run = True
 
     def get_nodename(self):
@@ -38,61 +86,63 @@ class SendRecvProcess(mp.Process):
         return self._sock
 
     def _recv_data(self, sock):
-        datafragments = []
         try:
-            while True:
-                datapiece = sock.recv(TCP_BUFFER_SIZE).decode("utf8")
-                datafragments.append(datapiece)
-                if '\n' in datapiece:
-                    break
-                if len(datapiece) == 0:
-                    break
-        except:
-            #Ignore the exception!
-            pass
-        return ''.join(datafragments)
+            return sock.recv(TCP_BUFFER_SIZE)
+        except OSError:
+            return b''
 
     def close_connection(self):
-        self._sock.shutdown(socket.SHUT_RDWR)
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            #Peer has closed already.
+            pass
         self._sock.close()
 
     def _recvthread(self):
-        savebuf = ''
-        while True:
+        framer = starsutil.LineFramer(self._maxline)
+        while self._run:
             data = self._recv_data(self._sock)
-            if (len(savebuf) != 0):
-                data = savebuf + data
-                savebuf = ''
-            if (len(data) != 0):
-                m = re.split(r"\r*\n", data)
-                if '' in m:
-                    m.remove('')
-                else:
-                    savebuf = m[-1]
-                    del m[-1]
-                for buf in m:
-                    if re.match(r"(?i)^(exit|quit)", buf):
-                        self.close_connection()
-                        self._run = False
-                        break
-                    else:
-                        datamsg = StarsMessage(self._mynodename, buf)
-                        self._recv_q.put(datamsg)
-            else:
+            if (len(data) == 0):
                 self.close_connection()
-                self._run = False
-
+                break
+            try:
+                lines = framer.feed(data)
+            except starsutil.LineTooLongError as ex:
+                print('Connection closed: ', self._mynodename, ex)
+                self.close_connection()
+                break
+            for i, buf in enumerate(lines):
+                if re.match(r"(?i)^(exit|quit)", buf):
+                    del lines[i:]
+                    self._run = False
+                    break
+            #All lines of one recv as one message.
+            if lines:
+                self._recv_q.put(StarsMessage(self._mynodename, lines))
             if not self._run:
+                self.close_connection()
                 break
+        #Data None tells the server that the node has gone, before this process has ended.
+        self._recv_q.put(StarsMessage(self._mynodename, None, os.getpid()))
 
     def _sendthread(self):
+        outbuf = starsutil.SendBuffer()
         while True:
-            sendmsg = self._send_q.get(block=True)
-            buf = sendmsg.get_data().encode()
             try:
-                while len(buf) > 0:
-                    send = self._sock.send(buf)
-                    buf = buf[send:]
+                sendmsg = self._send_q.get(block=True)
+            except EOFError:
+                #Channel has been closed by the server.
+                break
+            outbuf.append(sendmsg.get_data())
+            #Gather whatever is already queued into one sendmsg() call.
+            try:
+                while len(outbuf) < SEND_GATHER_BYTES:
+                    outbuf.append(self._send_q.get_nowait().get_data())
+            except queue.Empty:
+                pass
+            try:
+                outbuf.sendall(self._sock)
             except Exception:
                 self.close_connection()
                 break
@@ -113,23 +163,27 @@ class SendRecvProcess(mp.Process):
 
 
 class Starsserver:
-    def __init__(self, port, lib, key):
+    def __init__(self, port, lib, key, maxline=None, transport='queue', metricsport=None, recorder=None,
+                 recordersize=starsrecorder.RECORDER_SIZE):
         self._port = port
         self._libdir = lib
+        self._maxline = maxline
+        self._metricsport = metricsport
+        self._recorderfile = recorder
+        self._recordersize = recordersize
+        self._recorder = None
         if (key is None) or (key == ''):
             self._keydir = lib
         else:
             self._keydir = key
 
         self._node = []
-        self._node_flgon = {}
-
-        self._cmddeny = []
-        self._cmdallow = []
-        self._reconndeny = []
-        self._reconnallow = []
-        self._aliasreal = {}
-        self._realalias = {}
+        self._node_flgon = starsutil.FlgonTable()
+        self._taps = {}
+        self._groups = {}
+
+        self._config = starsconfig.LibConfig()
+        self._configwatcher = None
         self._initialized = True
 
         self._socket = None
@@ -138,8 +192,27 @@ class Starsserver:
         self._proc_check_thread = None
         self._lock = threading.Lock()
         self._process_n = {}
+        self._sentinels = {}
+        self._reap_r, self._reap_w = mp.Pipe(duplex=False)
         self._recv_q = mp.Queue()
         self._send_dict = {}
+        self._batch = threading.local()
+        if (transport == 'shm') and not starsring.HAS_SHM:
+            print('Shared memory is not available, queues will be used.')
+            transport = 'queue'
+        self._transport = transport
+        self._recv_rings = {}
+        self._closed_rings = deque()
+        self._ringctl_r, self._ringctl_w = mp.Pipe(duplex=False)
+        self._overflow = {}
+        self._overflow_lock = threading.Lock()
+        self._handshakes = {}
+        self._resolved = deque()
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._handshake_latency = starsutil.LatencyStats()
+        self._metrics = starsmetrics.Metrics()
+        self._profiler = starsmetrics.Profiler()
 
     def runserver(self):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -158,121 +231,510 @@ class Starsserver:
         self._proc_check_thread.daemon = True
         self._proc_check_thread.start()
 
+        if self._metricsport:
+            starsmetrics.MetricsEndpoint(self._metricsport, self._metricstext).start()
+
         self._listener_thread.join()
         self._msg_handle_thread.join()
         self._proc_check_thread.join()
 
-    def _sendconnmsg(self, xfh, xbuf):
+    def _metricstext(self):
+        #Called from the endpoint thread; counters and gauges are read without locking.
+        return self._metrics.exposition(self._gauges(), self._nodegauges())
+
+    def _channeldepth(self, channel):
+        """Messages waiting in a send channel, None if the channel can not tell."""
+        try:
+            return channel.qsize()
+        except (AttributeError, NotImplementedError):
+            return None
+
+    def _gauges(self):
+        gauges = {'nodes': len(self._node), 'handshakes_pending': len(self._handshakes),
+                  'processes': len(self._process_n)}
+        depth = self._channeldepth(self._recv_q)
+        if depth is not None:
+            gauges['recv_queued'] = depth
+        depths = [d for d in self._nodegauges()['queued'].values()]
+        if depths:
+            gauges['send_queued'] = sum(depths)
+            gauges['send_queued_max'] = max(depths)
+        return gauges
+
+    def _nodegauges(self):
+        depths = {}
+        for node, channel in list(self._send_dict.items()):
+            depth = self._channeldepth(channel)
+            if depth is not None:
+                depths[node] = depth
+        return {'queued': depths}
+
+    def _nodepending(self, node):
+        channel = self._send_dict.get(node)
+        depth = self._channeldepth(channel) if channel is not None else None
+        return '-' if depth is None else depth
+
+    def _sendconnmsg(self, xfh, xbuf, tonode=None):
+        """Returns False if the socket has failed and is closed."""
         buf = xbuf.encode()
         try:
-            while len(buf) > 0:
-                send = xfh.send(buf)
-                buf = buf[send:]
+            xfh.sendall(buf)
         except Exception:
             xfh.close()
-        if 'Debugger' in self._node:
-            dmsg = StarsMessage(None, xbuf)
-            self._send_dict['Debugger'].put(dmsg)
+            return False
+        if self._taps:
+            self._copytotaps(tonode, xbuf, buf)
+        return True
+
+    def _puttosend(self, tonode, buf):
+        data = buf.encode()
+        self._putdata(tonode, data)
+        if self._taps:
+            self._copytotaps(tonode, buf, data)
+
+    def _putdata(self, tonode, data):
+        metrics = self._metrics
+        metrics.msgs_out += 1
+        metrics.bytes_out += len(data)
+        metrics.node_out[tonode] += 1
+        if self._recorder is not None:
+            self._recorder.record(starsrecorder.REC_OUT, '', tonode, data)
+        batch = getattr(self._batch, 'out', None)
+        if batch is not None:
+            #Sent by _routebatch() when the batch is done.
+            batch.setdefault(tonode, []).append(data)
+        else:
+            self._putchannel(tonode, self._send_dict[tonode], data)
 
-    def _recvconnmsg(self, xfh):
-        datafragments = []
+    def _putparts(self, tonode, parts):
+        """Like _putdata() for a line in parts, joined only once per batch of tonode."""
+        batch = getattr(self._batch, 'out', None)
+        if batch is None:
+            return self._putdata(tonode, b''.join(parts))
+        size = sum(len(part) for part in parts)
+        metrics = self._metrics
+        metrics.msgs_out += 1
+        metrics.bytes_out += size
+        metrics.node_out[tonode] += 1
+        if self._recorder is not None:
+            self._recorder.record(starsrecorder.REC_OUT, '', tonode, b''.join(part[:starsrecorder.RECORD_BODY] for part in parts), size)
+        batch.setdefault(tonode, []).extend(parts)
+
+    def _putchannel(self, tonode, channel, data):
+        """Sends data to the channel of tonode. A full ring never blocks the caller:
+        the data waits in the overflow of the node and is sent by later passes of
+        the message handler. A node whose overflow exceeds OVERFLOW_SIZE does not
+        read anymore, it is disconnected."""
+        if self._transport != 'shm':
+            channel.put(StarsMessage(None, data))
+            return
+        with self._overflow_lock:
+            overflow = self._overflow.get(tonode)
+            if (overflow is None) and (len(data) <= starsring.PUT_SIZE):
+                try:
+                    channel.put(StarsMessage(None, data), False)
+                    return
+                except queue.Full:
+                    pass
+            if overflow is None:
+                overflow = self._overflow[tonode] = Overflow()
+            for start in range(0, len(data), starsring.PUT_SIZE):
+                overflow.chunks.append(data[start:start + starsring.PUT_SIZE])
+            overflow.size += len(data)
+            self._flushoverflow(tonode, channel, overflow)
+            if overflow.size <= OVERFLOW_SIZE:
+                return
+            del self._overflow[tonode]
+            self._metrics.overflow_dropped += len(overflow.chunks)
+        print('Send buffer of %s is full, it will be disconnected.' %tonode)
+        self._disconnect_and_terminate(tonode)
+
+    def _flushoverflow(self, tonode, channel, overflow):
+        """Sends what fits into the ring. Call with _overflow_lock held."""
+        chunks = overflow.chunks
         try:
-            while True:
-                datapiece = xfh.recv(TCP_BUFFER_SIZE).decode("utf8")
-                if not datapiece:
-                    break
-                if '\n' in datapiece:
-                    break
-            datafragments.append(datapiece)
-        except:
-        #Ignore the exception!
-            pass
-        return ''.join(datafragments)
+            while chunks:
+                channel.put(StarsMessage(None, chunks[0]), False)
+                overflow.size -= len(chunks.popleft())
+        except queue.Full:
+            return
+        del self._overflow[tonode]
 
-    def _puttosend(self, tonode, buf):
-        sendmsg = StarsMessage(None, buf)
-        self._send_dict[tonode].put(sendmsg)
-        if 'Debugger' in self._node:
-            self._send_dict['Debugger'].put(sendmsg)
+    def _drainoverflow(self):
+        with self._overflow_lock:
+            for tonode, overflow in list(self._overflow.items()):
+                channel = self._send_dict.get(tonode)
+                if channel is None:
+                    del self._overflow[tonode]
+                else:
+                    self._flushoverflow(tonode, channel, overflow)
+
+    def _copytotaps(self, tonode, buf, data):
+        """Copies data to the taps whose filter matches, gathered per batch like the node output."""
+        taps = getattr(self._batch, 'taps', None)
+        for tap in tuple(self._taps.values()):
+            if (tap.node == tonode) or not tap.matches(buf):
+                continue
+            if taps is not None:
+                taps.setdefault(tap, []).append(data)
+            else:
+                self._puttap(tap, data)
+
+    def _puttap(self, tap, data):
+        """Never blocks: the data is dropped if the channel of the tap is full."""
+        channel = self._send_dict.get(tap.node)
+        if channel is None:
+            return
+        depth = self._channeldepth(channel)
+        if depth is not None:
+            #The channel is FIFO, so at most the last depth copies are still waiting.
+            queued = tap.queued
+            while len(queued) > depth:
+                queued.popleft()
+            if (depth >= starsutil.TAP_QUEUE_SIZE) or (sum(queued) + len(data) > starsutil.TAP_BUFFER_SIZE):
+                tap.dropped += 1
+                self._metrics.tap_dropped += 1
+                return
+        try:
+            channel.put_nowait(StarsMessage(None, data))
+        except queue.Full:
+            tap.dropped += 1
+            self._metrics.tap_dropped += 1
+            return
+        tap.copied += 1
+        if depth is not None:
+            tap.queued.append(len(data))
 
     def _listener(self):
+        """Accepts connections and runs all logins in one selector loop, so a
+        client that does not answer can not block other logins."""
+        sel = selectors.DefaultSelector()
+        self._socket.setblocking(False)
+        sel.register(self._socket, selectors.EVENT_READ)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        sel.register(self._wakeup_r, selectors.EVENT_READ)
+        nextexpire = time.monotonic() + 1.0
         while True:
-            new_sock, _unused = self._socket.accept()
-            bufhn, ipadr = starsutil.system_gethostname_or_ip(new_sock)
-            if not starsutil.system_checkhost(starsutil.get_hostlist(), bufhn, ipadr, False, self._libdir):
-                self._sendconnmsg(new_sock, "Bad host. %s\n" %bufhn)
-                new_sock.close()
-            else:
-                nodekey = starsutil.get_nodeidkey()
-                self._sendconnmsg(new_sock, "%s\n" %nodekey)
-                data = self._recvconnmsg(new_sock)
-                if (len(data) != 0):
-                    add, node = self._addnode(new_sock, data.strip(), nodekey)
-                    if add:
-                        process = SendRecvProcess(node, new_sock, self._recv_q, self._send_dict[node])
-                        process.daemon = True
-                        process.start()
-                        self._lock.acquire()
-                        self._process_n[node] = process
-                        self._lock.release()
-                new_sock.close()
+            for key, _unused in sel.select(1.0):
+                if key.fileobj is self._socket:
+                    self._accepthandshakes()
+                elif key.fileobj is self._wakeup_r:
+                    self._resolvedhandshakes(sel)
+                else:
+                    try:
+                        self._recvhandshake(sel, key.data)
+                    except Exception as ex:
+                        #One broken login must not end the listener.
+                        print('Exception occurred: ', ex)
+                        if key.data.sock in self._handshakes:
+                            self._endhandshake(sel, key.data, False)
+            now = time.monotonic()
+            if now >= nextexpire:
+                nextexpire = now + 1.0
+                for hs in [hs for hs in self._handshakes.values() if hs.deadline <= now]:
+                    self._endhandshake(sel, hs, False)
 
-    def _check_process(self):
+    def _accepthandshakes(self):
         while True:
+            try:
+                new_sock, peer = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                print('Exception occurred: ', ex)
+                return
+            new_sock.setblocking(False)
+            hs = Handshake(new_sock, peer[0], self._maxline)
+            self._handshakes[new_sock] = hs
+            bufhn = starsutil.lookup_hostname(hs.ip, lambda host, hs=hs: self._hostresolved(hs, host))
+            if bufhn is not None:
+                self._hostresolved(hs, bufhn)
+
+    def _hostresolved(self, hs, bufhn):
+        #Called from the resolver threads, the listener loop continues the login.
+        self._resolved.append((hs, bufhn))
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            pass
+
+    def _resolvedhandshakes(self, sel):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
+        while self._resolved:
+            hs, bufhn = self._resolved.popleft()
+            if hs.sock not in self._handshakes:
+                continue
+            try:
+                self._sendnodekey(sel, hs, bufhn)
+            except Exception as ex:
+                print('Exception occurred: ', ex)
+                if hs.sock in self._handshakes:
+                    self._endhandshake(sel, hs, False)
+
+    def _sendnodekey(self, sel, hs, bufhn):
+        hs.host = bufhn
+        if not starsutil.system_checkhost(starsutil.get_hostlist(), bufhn, hs.ip, False, self._libdir):
+            self._sendconnmsg(hs.sock, "Bad host. %s\n" %bufhn)
+            self._endhandshake(sel, hs, False)
+            return
+        hs.nodekey = starsutil.get_nodeidkey()
+        if (not self._sendconnmsg(hs.sock, "%s\n" %hs.nodekey)) or (hs.sock.fileno() < 0):
+            #The client has reset the connection.
+            self._endhandshake(sel, hs, False)
+            return
+        sel.register(hs.sock, selectors.EVENT_READ, hs)
+
+    def _recvhandshake(self, sel, hs):
+        try:
+            data = hs.sock.recv(TCP_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._endhandshake(sel, hs, False)
+            return
+        try:
+            lines = hs.framer.feed(data)
+        except starsutil.LineTooLongError:
+            self._endhandshake(sel, hs, False)
+            return
+        if not lines:
+            return
+        sel.unregister(hs.sock)
+        hs.sock.setblocking(True)
+        add, node = self._addnode(hs.sock, lines[0].strip(), hs.nodekey, hs.host, hs.ip)
+        if add:
+            self._startnode(node, hs.sock)
+        self._endhandshake(None, hs, add)
+
+    def _startnode(self, node, sock):
+        recv_q = self._recv_q
+        if self._transport == 'shm':
+            recv_q = starsring.RingChannel(StarsMessage, node)
             self._lock.acquire()
-            for node in list(self._process_n):
-                nProc = self._process_n[node]
-                if nProc.exitcode == 13:
-                    nProc.join()
+            self._recv_rings[node] = recv_q
+            self._ringctl_w.send_bytes(b'')
             self._lock.release()
-            time.sleep(0.5)
+        process = SendRecvProcess(node, sock, recv_q, self._send_dict[node], self._maxline)
+        process.daemon = True
+        process.start()
+        self._lock.acquire()
+        self._process_n[node] = process
+        self._sentinels[process.sentinel] = process
+        self._reap_w.send_bytes(b'')
+        self._lock.release()
+
+    def _sendchannel(self, node):
+        if self._transport == 'shm':
+            return starsring.RingChannel(StarsMessage)
+        return mp.Queue()
+
+    def _dropchannels(self, node):
+        """Remove the send channel of node and, with shared memory, its rings. Call with _lock held."""
+        channel = self._send_dict.pop(node, None)
+        if self._transport != 'shm':
+            return
+        if channel is not None:
+            channel.close()
+        with self._overflow_lock:
+            self._overflow.pop(node, None)
+        ring = self._recv_rings.pop(node, None)
+        if ring is not None:
+            #Closed by the message handler, it may be reading the ring just now.
+            self._closed_rings.append(ring)
+            self._ringctl_w.send_bytes(b'')
+
+    def _endhandshake(self, sel, hs, success):
+        del self._handshakes[hs.sock]
+        if success:
+            self._handshake_latency.add(time.monotonic() - hs.started)
+            self._metrics.handshakes += 1
+        else:
+            self._metrics.handshake_failed += 1
+        if sel is not None:
+            try:
+                sel.unregister(hs.sock)
+            except (KeyError, ValueError):
+                pass
+        hs.sock.close()
+
+    def _check_process(self):
+        """Waits on the sentinels of the node processes, so a node is removed as soon as its process has ended."""
+        while True:
             self._lock.acquire()
-            for node in list(self._process_n):
-                nProc = self._process_n[node]
-                if nProc.is_alive() == False:
-                    if node in self._node:
-                        self._delnode(node)
-                    del self._send_dict[node]
-                    del self._process_n[node]
+            waiters = list(self._sentinels)
             self._lock.release()
+            waiters.append(self._reap_r)
+            for ready in mp_connection.wait(waiters):
+                if ready is self._reap_r:
+                    while self._reap_r.poll():
+                        self._reap_r.recv_bytes()
+                    continue
+                self._lock.acquire()
+                process = self._sentinels.pop(ready, None)
+                if process is not None:
+                    process.join()
+                    node = process.get_nodename()
+                    if self._process_n.get(node) is process:
+                        if node in self._node:
+                            self._delnode(node)
+                        self._dropchannels(node)
+                        del self._process_n[node]
+                self._lock.release()
+
+    def _nodeclosed(self, node, pid):
+        """The connection of node has been closed, its process will end soon and is joined by _check_process()."""
+        self._lock.acquire()
+        process = self._process_n.get(node)
+        if (process is not None) and (process.pid == pid):
+            if node in self._node:
+                self._delnode(node)
+            self._dropchannels(node)
+            del self._process_n[node]
+        self._lock.release()
 
     def _msg_handler(self):
+        if self._transport == 'shm':
+            return self._ring_handler()
+        while True:
+            msgs = [self._recv_q.get(block=True)]
+            try:
+                while len(msgs) < MSG_BATCH:
+                    msgs.append(self._recv_q.get_nowait())
+            except queue.Empty:
+                pass
+            self._routebatch(msgs)
+
+    def _routebatch(self, msgs):
+        """Routes received messages and sends the output gathered per node with one put()."""
+        out = self._batch.out = {}
+        taps = self._batch.taps = {}
+        metrics = self._metrics
+        try:
+            for rmsg in msgs:
+                data = rmsg.get_data()
+                if isinstance(data, list):
+                    fromnode = rmsg.get_from()
+                    metrics.msgs_in += len(data)
+                    metrics.node_in[fromnode] += len(data)
+                    for buf in data:
+                        metrics.bytes_in += len(buf) + 1
+                        start = time.perf_counter()
+                        self._sendmes(StarsMessage(fromnode, buf))
+                        metrics.route.add(time.perf_counter() - start)
+                else:
+                    self._sendmes(rmsg)
+        finally:
+            self._batch.out = None
+            self._batch.taps = None
+        for tonode, bufs in out.items():
+            channel = self._send_dict.get(tonode)
+            if channel is not None:
+                self._putchannel(tonode, channel, b''.join(bufs))
+        for tap, bufs in taps.items():
+            self._puttap(tap, b''.join(bufs))
+
+    def _ring_handler(self):
+        """Reads the shared memory rings of all nodes and sleeps on their wakeup pipes."""
         while True:
-            rmsg = self._recv_q.get(block=True)
-            self._sendmes(rmsg)
+            rings = list(self._recv_rings.items())
+            msgs = []
+            for node, ring in rings:
+                for buf in ring.get_all():
+                    if buf is None:
+                        #Ignored if the node has already a new ring after a reconnect.
+                        process = self._process_n.get(node)
+                        if (self._recv_rings.get(node) is ring) and (process is not None):
+                            msgs.append(StarsMessage(node, None, process.pid))
+                        continue
+                    msgs.append(StarsMessage(node, buf.decode('utf8', 'replace').split('\n')))
+            if msgs:
+                self._routebatch(msgs)
+            if self._overflow:
+                self._drainoverflow()
+            if not msgs:
+                sleeping = [ring for node, ring in rings if ring.prepare_wait()]
+                if len(sleeping) == len(rings):
+                    waiters = [ring.get_waiter() for ring in sleeping]
+                    waiters.append(self._ringctl_r)
+                    #Rings of slow nodes are polled for their overflow.
+                    mp_connection.wait(waiters, OVERFLOW_WAIT if self._overflow else starsring.RING_WAIT)
+                for ring in sleeping:
+                    ring.end_wait()
+            while self._ringctl_r.poll():
+                self._ringctl_r.recv_bytes()
+            while self._closed_rings:
+                self._closed_rings.popleft().close()
 
     def _sendmes(self, frommsg):
         buf = frommsg.get_data()
         fromnode = fromnodes = sendh = frommsg.get_from()
-        m = re.match(r"^([a-zA-Z_0-9.\-]+)>", buf)
-        buf = re.sub(r"^([a-zA-Z_0-9.\-]+)>", '', buf, count=1)
-        if m:
-            fromnode = m.group(1)
-        m = re.match(r"^([a-zA-Z_0-9.\-]+)\s*", buf)
-        buf = re.sub(r"^([a-zA-Z_0-9.\-]+)\s*", '', buf, count=1)
-        if not m:
+        if buf is None:
+            return self._nodeclosed(sendh, frommsg.get_connid())
+        fromover, tonodes, tonode, buf, kind = starsutil.parse_message(buf)
+        if fromover is not None:
+            fromnode = fromover
+        if self._recorder is not None:
+            self._recorder.record(starsrecorder.REC_IN, fromnode, tonodes or '', buf)
+        if tonodes is None:
             self._puttosend(sendh, "System>%s> @\n" %fromnode)
             return
-        tonodes = m.group(1)
-        if tonodes in self._aliasreal:
-            tonodes = self._aliasreal[tonodes]
-        if (re.match(r"^[^@]", buf)) and (((self._cmddeny) and (starsutil.isdenycheckcmd_deny(fromnodes, tonodes, buf, self._cmddeny)))\
-            or ((self._cmdallow) and (starsutil.isdenycheckcmd_allow(fromnodes, tonodes, buf, self._cmdallow)))):
-            if re.match(r"^[^_]", buf):
+        config = self._config
+        if tonodes in config.aliasreal:
+            tonodes = config.aliasreal[tonodes]
+            tonode = tonodes.split('.', 1)[0]
+        if (tonode in self._groups) and (tonode not in self._node):
+            #Checked per member by _sendgroup().
+            return self._sendgroup(sendh, fromnode, tonodes, self._groups[tonode], buf, kind)
+        if ((kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EVENT))\
+            and config.cmdperm.isdenied(fromnodes, tonodes, buf):
+            self._metrics.denied += 1
+            if kind == starsutil.MSG_COMMAND:
                 self._puttosend(sendh, "System>%s @%s Er: Command denied.\n" %(fromnode, buf))
             return
-        tonode = tonodes
-        tonode = tonode.split('.', 1)[0]
         if tonode == 'System':
             return self._system_commands(sendh, fromnode, buf)
         if not tonode in self._node:
-            if not re.match(r"^[_@]", buf):
+            if (kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EMPTY):
                 self._puttosend(sendh, "System>%s @%s Er: %s is down.\n" %(fromnode, buf, tonode))
             return
-        if fromnode in self._realalias:
-            fromnode = self._realalias[fromnode]
+        if fromnode in config.realalias:
+            fromnode = config.realalias[fromnode]
         self._puttosend(tonode, "%s>%s %s\n" %(fromnode, tonodes, buf))
 
+    def _sendgroup(self, sendh, fromnode, tonodes, members, buf, kind):
+        """Every member receives the line with its own name as the receiver, as if it
+        had been sent to it directly. The command permissions are checked per member.
+        The parts before and after the member name are encoded once; the line of a
+        member is joined with the other output of its batch."""
+        config = self._config
+        if (kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EVENT):
+            members, denied = config.cmdperm.splitmembers(sendh, tonodes, members, buf)
+            if denied:
+                self._metrics.denied += len(denied)
+                if kind == starsutil.MSG_COMMAND:
+                    for member in denied:
+                        self._puttosend(sendh, "System>%s @%s Er: Command denied for %s.\n" %(fromnode, buf, member))
+        frm = config.realalias.get(fromnode, fromnode)
+        suffix = tonodes[len(tonodes.split('.', 1)[0]):]
+        head = ("%s>" %frm).encode()
+        tail = ("%s %s\n" %(suffix, buf)).encode()
+        for member in members:
+            if member in self._send_dict:
+                name = member.encode()
+                self._putparts(member, (head, name, tail))
+                if self._taps:
+                    self._copytotaps(member, "%s>%s%s %s\n" %(frm, member, suffix, buf), head + name + tail)
+            elif (kind == starsutil.MSG_COMMAND) or (kind == starsutil.MSG_EMPTY):
+                self._puttosend(sendh, "System>%s @%s Er: %s is down.\n" %(fromnode, buf, member))
+
     def _system_commands(self, sendh, frn, cmd):
         if cmd.startswith('_'):
             self._system_event(frn, cmd)
@@ -286,18 +748,41 @@ class Starsserver:
             cmd = cmd.replace('flgoff ', '')
             self._system_flgoff(sendh, frn, cmd)
         elif cmd == 'loadreconnectablepermission':
-            starsutil.system_loadreconnecttablepermission(self._libdir, self._reconndeny, self._reconnallow)
-            self._puttosend(sendh, "System>%s @loadreconnectablepermission Reconnectable permission list has been loaded.\n" %frn)
+            self._system_reload(sendh, frn, cmd, 'Reconnectable permission list has been loaded.')
         elif cmd == 'loadpermission':
-            starsutil.system_loadcommandpermission(self._libdir, self._cmddeny, self._cmdallow)
-            self._puttosend(sendh, "System>%s @loadpermission Command permission list has been loaded.\n" %frn)
+            self._system_reload(sendh, frn, cmd, 'Command permission list has been loaded.')
+        elif cmd == 'loadkeys':
+            starsutil.system_loadkeys()
+            self._puttosend(sendh, "System>%s @loadkeys Key files will be reloaded.\n" %frn)
+        elif cmd == 'handshakestats':
+            self._puttosend(sendh, "System>%s @handshakestats %s failed=%d pending=%d\n" %(frn,
+                self._handshake_latency.summary(), self._metrics.handshake_failed, len(self._handshakes)))
         elif cmd == 'loadaliases':
-            starsutil.system_loadaliases(self._libdir, self._aliasreal, self._realalias)
-            self._puttosend(sendh, "System>%s @loadaliases Aliases has been loaded.\n" %frn)
+            self._system_reload(sendh, frn, cmd, 'Aliases has been loaded.')
         elif cmd == 'listaliases':
-            self._puttosend(sendh, "System>%s @listaliases %s\n" %(frn, starsutil.system_listaliases(self._aliasreal)))
+            self._puttosend(sendh, "System>%s @listaliases %s\n" %(frn, starsutil.system_listaliases(self._config.aliasreal)))
+        elif re.match(r"groupdef ", cmd):
+            self._system_groupdef(sendh, frn, cmd[9:])
+        elif re.match(r"groupdel ", cmd):
+            self._system_groupdel(sendh, frn, cmd[9:])
+        elif cmd == 'listgroups':
+            self._puttosend(sendh, "System>%s @listgroups %s\n" %(frn, starsutil.system_listgroups(self._groups)))
         elif cmd == 'listnodes':
             self._puttosend(sendh, "System>%s @listnodes %s\n" %(frn, starsutil.system_listnodes(self._node)))
+        elif cmd == 'stats':
+            self._puttosend(sendh, "System>%s @stats %s\n" %(frn, self._metrics.summary(self._gauges())))
+        elif re.match(r"stats ", cmd):
+            cmd = cmd.replace('stats ', '')
+            self._system_stats(sendh, frn, cmd)
+        elif re.match(r"profile ", cmd):
+            cmd = cmd.replace('profile ', '')
+            self._system_profile(sendh, frn, cmd)
+        elif (cmd == 'tap') or re.match(r"tap ", cmd):
+            self._system_tap(sendh, frn, cmd[4:])
+        elif cmd == 'untap':
+            self._system_untap(sendh, frn)
+        elif cmd == 'listtaps':
+            self._puttosend(sendh, "System>%s @listtaps %s\n" %(frn, ', '.join(tap.summary() for tap in tuple(self._taps.values()))))
         elif cmd == 'getversion':
             self._puttosend(sendh, "System>%s @getversion Version: %s Date: %s\n" %(frn, __version__, __date__))
         elif cmd == 'gettime':
@@ -305,7 +790,7 @@ class Starsserver:
         elif cmd == 'hello':
             self._puttosend(sendh, "System>%s @hello Nice to meet you.\n" %frn)
         elif cmd == 'help':
-            self._puttosend(sendh, "System>%s @help flgon flgoff loadaliases listaliases loadpermission loadreconnectablepermission listnodes gettime hello disconnect\n" %frn)
+            self._puttosend(sendh, "System>%s @help flgon flgoff loadaliases listaliases loadpermission loadreconnectablepermission loadkeys handshakestats groupdef groupdel listgroups listnodes stats profile tap untap listtaps gettime hello disconnect\n" %frn)
         elif cmd.startswith('@'):
             return True
         else:
@@ -313,28 +798,58 @@ class Starsserver:
         return True
 
     def _system_event(self, frn, cmd):
-        to = None
-        if frn in self._realalias:
-            frn = self._realalias[frn]
-        for key in self._node_flgon.keys():
-            if re.search(frn, self._node_flgon[key]):
-                to = topre = key
-                topre = topre.split('.', 1)[0]
-                self._puttosend(topre, "%s>%s %s\n" %(frn, to, cmd))
-
-    def _addnode(self, sendh, buff, nodekey):
+        frn = self._config.realalias.get(frn, frn)
+        self._sendevent(frn, self._node_flgon.targets(frn), cmd)
+
+    def _sendevent(self, node, targets, event):
+        """Sends "node>subscriber event" to the (node, subscriber, encoded subscriber)
+        targets. The line is rendered once as bytes before and after the subscriber
+        name. Within a batch every receiver only gathers references to them, the
+        parts are joined once per receiver and batch by _routebatch()."""
+        head = ("%s>" %node).encode()
+        tail = (" %s\n" %event).encode()
+        size = len(head) + len(tail)
+        send_dict = self._send_dict
+        metrics = self._metrics
+        node_out = metrics.node_out
+        recorder = self._recorder
+        batch = getattr(self._batch, 'out', None)
+        count = nbytes = 0
+        for topre, key, name in targets:
+            if topre not in send_dict:
+                continue
+            count += 1
+            nbytes += size + len(name)
+            node_out[topre] += 1
+            if recorder is not None:
+                recorder.record(starsrecorder.REC_OUT, '', topre, head + name + tail[:starsrecorder.RECORD_BODY], size + len(name))
+            if batch is not None:
+                out = batch.get(topre)
+                if out is None:
+                    out = batch[topre] = []
+                out.append(head)
+                out.append(name)
+                out.append(tail)
+            else:
+                send_dict[topre].put(StarsMessage(None, head + name + tail))
+            if self._taps:
+                self._copytotaps(topre, "%s>%s %s\n" %(node, key, event), head + name + tail)
+        metrics.msgs_out += count
+        metrics.bytes_out += nbytes
+
+    def _addnode(self, sendh, buff, nodekey, host, ip):
         try:
             node, idmess = buff.split(' ')
         except Exception:
             return False, None
         reconnectflag = False
         if node in self._node:
-            if not starsutil.check_reconnecttable(node, sendh, self._reconndeny, self._reconnallow):
+            if not starsutil.check_reconnecttable(node, host, self._config.reconndeny, self._config.reconnallow):
                 self._sendconnmsg(sendh, "System> Er: %s already exists.\n" %node)
                 return False, node
             else:
                 reconnectflag = True
-        if not starsutil.check_term_and_host(node, sendh, self._libdir):
+        if not starsutil.check_term_and_host(node, host, ip, self._libdir):
             self._sendconnmsg(sendh, "System> Er: Bad host for %s\n" %node)
             return False, node
         if not starsutil.check_nodekey(node, nodekey, idmess, self._keydir):
@@ -343,33 +858,24 @@ class Starsserver:
         if reconnectflag:
             self._disconnect_for_reconnect(node)
         self._node.append(node)
-        self._send_dict[node] = mp.Queue()
-        self._sendconnmsg(sendh, "System>%s Ok:\n" %node)
-        if node in self._realalias:
-            node = self._realalias[node]
-        for key in self._node_flgon.keys():
-            if re.search(node, self._node_flgon[key]):
-                topre = key
-                topre = topre.split('.', 1)[0]
-                self._puttosend(topre, "%s>%s _Connected\n" %(node, key))
+        self._send_dict[node] = self._sendchannel(node)
+        if node == starsutil.DEBUGGER_NODE:
+            #Debugger gets every line, as before taps existed.
+            self._taps[node] = starsutil.Tap(node)
+        self._sendconnmsg(sendh, "System>%s Ok:\n" %node, node)
+        anode = self._config.realalias.get(node, node)
+        self._sendevent(anode, self._node_flgon.nodetargets(anode), '_Connected')
         return True, node
 
     def _delnode(self, node):
         try:
-            topre = None
             if node not in self._node:
                 return
             self._node.remove(node)
-            for key in list(self._node_flgon.keys()):
-                if re.findall(r"%s($|.)" %node, key):
-                    del self._node_flgon[key]
-            if node in self._realalias:
-                node = self._realalias[node]
-            for key in self._node_flgon.keys():
-                if re.search(node, self._node_flgon[key]):
-                    topre = key
-                    topre = topre.split('.', 1)[0]
-                    self._puttosend(topre, "%s>%s _Disconnected\n" %(node, key))
+            self._taps.pop(node, None)
+            self._node_flgon.dropnode(node)
+            node = self._config.realalias.get(node, node)
+            self._sendevent(node, self._node_flgon.nodetargets(node), '_Disconnected')
         except Exception as ex:
             print('Exception occurred: ', ex)
 
@@ -377,8 +883,7 @@ class Starsserver:
         if not re.match(r"^([a-zA-Z_0-9.\-]+)", cmd):
             self._puttosend(sendh, "System>%s @disconnect Er: Parameter is not enough.\n" %frn)
             return False
-        if cmd in self._aliasreal:
-            cmd = self._aliasreal[cmd]
+        cmd = self._config.aliasreal.get(cmd, cmd)
         if not cmd in self._node:
             self._puttosend(sendh, "System>%s @disconnect Er: Node %s is down.\n" %(frn, cmd))
             return False
@@ -386,18 +891,101 @@ class Starsserver:
         self._disconnect_and_terminate(cmd)
         return True
 
+    def _system_reload(self, sendh, frn, cmd, text):
+        """The lib files are read by the config watcher, the answer is sent when the new tables are used."""
+        def done(ok):
+            if sendh not in self._send_dict:
+                return
+            if ok:
+                self._puttosend(sendh, "System>%s @%s %s\n" %(frn, cmd, text))
+            else:
+                self._puttosend(sendh, "System>%s @%s Er: Lib files can not be loaded.\n" %(frn, cmd))
+        self._configwatcher.reload(done)
+        return True
+
+    def _setconfig(self, config):
+        #Called by the config watcher thread, the router picks it up with its next line.
+        self._config = config
+        print('Lib configuration has been loaded. Time:', time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+
+    def _system_groupdef(self, sendh, frn, cmd):
+        error = starsutil.system_groupdef(self._groups, cmd, self._node, self._config.aliasreal)
+        if error is not None:
+            self._puttosend(sendh, "System>%s @groupdef Er: %s\n" %(frn, error))
+            return False
+        name = cmd.split()[0]
+        self._puttosend(sendh, "System>%s @groupdef Group %s has been defined: %s.\n" %(frn, name, ' '.join(self._groups[name])))
+        return True
+
+    def _system_groupdel(self, sendh, frn, cmd):
+        if self._groups.pop(cmd.strip(), None) is None:
+            self._puttosend(sendh, "System>%s @groupdel Er: Group %s is not defined.\n" %(frn, cmd.strip()))
+            return False
+        self._puttosend(sendh, "System>%s @groupdel Group %s has been removed.\n" %(frn, cmd.strip()))
+        return True
+
+    def _system_stats(self, sendh, frn, cmd):
+        stats = []
+        for node in cmd.split():
+            node = self._config.aliasreal.get(node, node)
+            stats.append(self._metrics.nodesummary(node, self._nodepending(node)))
+        self._puttosend(sendh, "System>%s @stats %s\n" %(frn, ', '.join(stats)))
+        return True
+
+    def _system_profile(self, sendh, frn, cmd):
+        if cmd == 'start':
+            if not self._profiler.start():
+                self._puttosend(sendh, "System>%s @profile Er: Profiler is already running.\n" %frn)
+                return False
+            self._puttosend(sendh, "System>%s @profile Profiler has been started.\n" %frn)
+        elif cmd == 'stop':
+            if not self._profiler.stop():
+                self._puttosend(sendh, "System>%s @profile Er: Profiler is not running.\n" %frn)
+                return False
+            self._puttosend(sendh, "System>%s @profile Profiler has been stopped.\n" %frn)
+        elif cmd == 'dump':
+            try:
+                name = self._profiler.dump(self._libdir)
+            except Exception as ex:
+                self._puttosend(sendh, "System>%s @profile Er: %s\n" %(frn, ex))
+                return False
+            if name is None:
+                self._puttosend(sendh, "System>%s @profile Er: Profiler has not been started.\n" %frn)
+                return False
+            self._puttosend(sendh, "System>%s @profile Stats have been written to %s.prof and %s.txt.\n" %(frn, name, name))
+        else:
+            self._puttosend(sendh, "System>%s @profile Er: Parameter must be start, stop or dump.\n" %frn)
+            return False
+        return True
+
+    def _system_tap(self, sendh, frn, cmd):
+        if not starsutil.isallowedtap(sendh, self._config.tapallow):
+            self._puttosend(sendh, "System>%s @tap Er: Tap is not allowed for %s.\n" %(frn, sendh))
+            return False
+        try:
+            tap = starsutil.Tap(sendh, *cmd.split()[:3])
+        except ValueError as ex:
+            self._puttosend(sendh, "System>%s @tap Er: Bad filter, %s.\n" %(frn, ex))
+            return False
+        self._taps[sendh] = tap
+        self._puttosend(sendh, "System>%s @tap Tap %s has been registered.\n" %(frn, tap.spec))
+        return True
+
+    def _system_untap(self, sendh, frn):
+        if self._taps.pop(sendh, None) is None:
+            self._puttosend(sendh, "System>%s @untap Er: No tap registered.\n" %frn)
+            return False
+        self._puttosend(sendh, "System>%s @untap Tap has been removed.\n" %frn)
+        return True
+
     def _system_flgon(self, sendh, frn, cmd):
         if not re.match(r"^([a-zA-Z_0-9.\-]+)", cmd):
             self._puttosend(sendh, "System>%s @flgon Er: Parameter is not enough.\n" %frn)
             return False
-        if frn in self._node_flgon:
-            if (re.findall(cmd, self._node_flgon[frn])):
-                self._puttosend(sendh, "System>%s @flgon Er: Node %s is allready in the list.\n" %(frn, cmd))
-                return False
-            self._node_flgon[frn] += ' ' + cmd
-            self._puttosend(sendh, "System>%s @flgon Node %s has been registered.\n" %(frn, cmd))
-            return True
-        self._node_flgon[frn] = cmd
+        added = [name for name in cmd.split() if self._node_flgon.add(frn, name)]
+        if not added:
+            self._puttosend(sendh, "System>%s @flgon Er: Node %s is allready in the list.\n" %(frn, cmd))
+            return False
         self._puttosend(sendh, "System>%s @flgon Node %s has been registered.\n" %(frn, cmd))
         return True
 
@@ -405,17 +993,15 @@ class Starsserver:
         if not re.match(r"^([a-zA-Z_0-9.\-]+)", cmd):
             self._puttosend(sendh, "System>%s @flgoff Er: Parameter is not enough.\n" %frn)
             return False
-        if frn in self._node_flgon:
-            if (re.findall(cmd, self._node_flgon[frn])):
-                self._node_flgon[frn] = self._node_flgon[frn].replace(cmd, '').lstrip()
-                self._puttosend(sendh, "System>%s @flgoff Node %s has been removed.\n" %(frn, cmd))
-                return True
-            else:
-                self._puttosend(sendh, "System>%s @flgoff Er: Node %s is not in the list.\n" %(frn, cmd))
-                return False
-        else:
+        if frn not in self._node_flgon:
             self._puttosend(sendh, "System>%s @flgoff Er: List is void.\n" %frn)
             return False
+        removed = [name for name in cmd.split() if self._node_flgon.remove(frn, name)]
+        if not removed:
+            self._puttosend(sendh, "System>%s @flgoff Er: Node %s is not in the list.\n" %(frn, cmd))
+            return False
+        self._puttosend(sendh, "System>%s @flgoff Node %s has been removed.\n" %(frn, cmd))
+        return True
 
     def _disconnect_for_reconnect(self, node):
         self._disconnect_and_terminate(node)
@@ -423,16 +1009,24 @@ class Starsserver:
     def _disconnect_and_terminate(self, node):
         self._delnode(node)
         self._lock.acquire()
-        self._process_n[node].terminate()
-        self._process_n[node].join()
-        del self._process_n[node]
-        del self._send_dict[node]
+        process = self._process_n.pop(node, None)
+        if process is not None:
+            process.terminate()
+            process.join()
+            self._sentinels.pop(process.sentinel, None)
+        self._dropchannels(node)
+        self._reap_w.send_bytes(b'')
         self._lock.release()
 
     def startup(self):
         initialized = True
         random.seed()
-        initialized = starsutil.system_loadcommandpermission(self._libdir, self._cmddeny, self._cmdallow)
-        initialized = starsutil.system_loadaliases(self._libdir, self._aliasreal, self._realalias)
-        initialized = starsutil.system_loadreconnecttablepermission(self._libdir, self._reconndeny, self._reconnallow)
+        try:
+            self._config = starsconfig.load_libconfig(self._libdir)
+        except (OSError, ValueError, UnicodeDecodeError) as ex:
+            print('Can\'t load lib configuration! ', ex)
+            initialized = False
+        self._configwatcher = starsconfig.ConfigWatcher(self._libdir, self._config, self._setconfig)
+        self._configwatcher.start()
+        self._recorder = starsrecorder.open_recorder(self._recorderfile, self._libdir, self._recordersize)
         return initialized
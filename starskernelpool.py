@@ -0,0 +1,305 @@
+""" STARS Server worker pool module.
+
+Multiprocessing server with a fixed number of worker processes instead of
+one process per node. Each worker runs a selector loop over the sockets of
+many nodes. Routing stays in the main process (starskernelmp.Starsserver).
+"""
+
+import os
+import pickle
+import queue
+import socket
+import selectors
+import threading
+import zlib
+import multiprocessing as mp
+from multiprocessing import connection as mp_connection
+from multiprocessing.reduction import ForkingPickler
+from collections import deque
+import starsutil
+import starskernelmp
+import starsrecorder
+from starskernelmp import StarsMessage
+
+TCP_BUFFER_SIZE = starsutil.get_tcpbuffersize()
+ASSIGNMODES = ('load', 'hash')
+
+#Worker control messages
+WORKER_ADD = 0
+WORKER_SEND = 1
+WORKER_CLOSE = 2
+WORKER_TAP = 3
+
+class WorkerChannel:
+    """Send queue of one node in a worker; put() works like for the mp.Queue of SendRecvProcess.
+    Messages are held back until the worker got the socket."""
+    __slots__ = ('_ctl_q', '_node', '_lock', '_pending')
+
+    def __init__(self, ctl_q, node):
+        self._ctl_q = ctl_q
+        self._node = node
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def put(self, msg):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(msg.get_data())
+                return
+        self._ctl_q.put((WORKER_SEND, self._node, msg.get_data()))
+
+    def put_nowait(self, msg):
+        """Copy for a tap, the worker drops it when the output of the node is backed up."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(msg.get_data())
+                return
+        self._ctl_q.put((WORKER_TAP, self._node, msg.get_data()))
+
+    def start(self, connid, data):
+        with self._lock:
+            self._ctl_q.put((WORKER_ADD, self._node, connid, data))
+            for buf in self._pending:
+                self._ctl_q.put((WORKER_SEND, self._node, buf))
+            self._pending = None
+
+class WorkerConnection:
+    __slots__ = ('sock', 'node', 'connid', 'inbuf', 'outbuf', 'writing')
+
+    def __init__(self, sock, node, connid, maxline=None):
+        self.sock = sock
+        self.node = node
+        self.connid = connid
+        self.inbuf = starsutil.LineFramer(maxline)
+        self.outbuf = starsutil.SendBuffer()
+        self.writing = False
+
+class StarsWorker(mp.Process):
+    def __init__(self, index, ctl_q, recv_q, maxline=None):
+        super(StarsWorker, self).__init__()
+        self._index = index
+        self._ctl_q = ctl_q
+        self._recv_q = recv_q
+        self._maxline = maxline
+        self._sel = None
+        self._conns = {}
+        self._ctl = deque()
+        self._wakeup_r = None
+        self._wakeup_w = None
+
+    def get_ctlqueue(self):
+        return self._ctl_q
+
+    def run(self):
+        self._sel = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._sel.register(self._wakeup_r, selectors.EVENT_READ)
+        ctl_thread = threading.Thread(target=self._ctlthread)
+        ctl_thread.daemon = True
+        ctl_thread.start()
+        while True:
+            for key, events in self._sel.select():
+                if key.fileobj is self._wakeup_r:
+                    self._runctl()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_READ:
+                    self._recv(conn)
+                if (events & selectors.EVENT_WRITE) and (self._conns.get(conn.node) is conn):
+                    self._send(conn)
+
+    def _ctlthread(self):
+        #Moves control messages from the mp.Queue to the selector loop.
+        while True:
+            self._ctl.append(self._ctl_q.get(block=True))
+            try:
+                while True:
+                    self._ctl.append(self._ctl_q.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self._wakeup_w.send(b'\0')
+            except OSError:
+                pass
+
+    def _runctl(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
+        while self._ctl:
+            item = self._ctl.popleft()
+            if item[0] in (WORKER_SEND, WORKER_TAP):
+                conn = self._conns.get(item[1])
+                if (conn is not None) and ((item[0] == WORKER_SEND) or (len(conn.outbuf) < starsutil.TAP_BUFFER_SIZE)):
+                    conn.outbuf.append(item[2])
+                    self._send(conn)
+            elif item[0] == WORKER_ADD:
+                try:
+                    sock = pickle.loads(item[3])
+                except Exception as ex:
+                    print('Can\'t take over connection of %s: %s' %(item[1], ex))
+                    self._recv_q.put(StarsMessage(item[1], None, item[2]))
+                    continue
+                self._add(item[1], item[2], sock)
+            elif item[0] == WORKER_CLOSE:
+                conn = self._conns.get(item[1])
+                if (conn is not None) and (conn.connid == item[2]):
+                    self._close(conn, False)
+
+    def _add(self, node, connid, sock):
+        old = self._conns.get(node)
+        if old is not None:
+            self._close(old, False)
+        sock.setblocking(False)
+        conn = WorkerConnection(sock, node, connid, self._maxline)
+        self._conns[node] = conn
+        self._sel.register(sock, selectors.EVENT_READ, conn)
+
+    def _recv(self, conn):
+        try:
+            data = conn.sock.recv(TCP_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(conn, True)
+            return
+        try:
+            lines = conn.inbuf.feed(data)
+        except starsutil.LineTooLongError as ex:
+            print('Connection closed: ', conn.node, ex)
+            self._close(conn, True)
+            return
+        for i, buf in enumerate(lines):
+            if buf[:4].lower() in ('exit', 'quit'):
+                if i:
+                    self._recv_q.put(StarsMessage(conn.node, lines[:i]))
+                self._close(conn, True)
+                return
+        if lines:
+            self._recv_q.put(StarsMessage(conn.node, lines))
+
+    def _send(self, conn):
+        try:
+            while len(conn.outbuf):
+                conn.outbuf.send(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._close(conn, True)
+            return
+        writing = len(conn.outbuf) > 0
+        if writing != conn.writing:
+            conn.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self._sel.modify(conn.sock, events, conn)
+
+    def _close(self, conn, notify):
+        if self._conns.get(conn.node) is conn:
+            del self._conns[conn.node]
+        try:
+            self._sel.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        conn.outbuf.clear()
+        if notify:
+            #Data None tells the server that the node has gone.
+            self._recv_q.put(StarsMessage(conn.node, None, conn.connid))
+
+class Starsserver(starskernelmp.Starsserver):
+    def __init__(self, port, lib, key, maxline=None, workers=None, assign='load', metricsport=None,
+                 recorder=None, recordersize=starsrecorder.RECORDER_SIZE):
+        super(Starsserver, self).__init__(port, lib, key, maxline, metricsport=metricsport, recorder=recorder,
+                                          recordersize=recordersize)
+        self._workercount = workers or os.cpu_count() or 1
+        self._assign = assign if assign in ASSIGNMODES else 'load'
+        self._workers = []
+        self._worker_load = []
+        self._node_worker = {}
+        self._connid = 0
+
+    def runserver(self):
+        for index in range(self._workercount):
+            self._workers.append(self._startworker(index))
+            self._worker_load.append(0)
+        print('Worker processes: %d, assignment by %s.' %(self._workercount, self._assign))
+        super(Starsserver, self).runserver()
+
+    def _startworker(self, index):
+        worker = StarsWorker(index, mp.Queue(), self._recv_q, self._maxline)
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _sendchannel(self, node):
+        if self._assign == 'hash':
+            index = zlib.crc32(node.encode()) % self._workercount
+        else:
+            index = min(range(self._workercount), key=self._worker_load.__getitem__)
+        self._lock.acquire()
+        self._connid += 1
+        self._node_worker[node] = (index, self._connid)
+        self._worker_load[index] += 1
+        self._lock.release()
+        return WorkerChannel(self._workers[index].get_ctlqueue(), node)
+
+    def _gauges(self):
+        gauges = super(Starsserver, self)._gauges()
+        del gauges['processes']
+        gauges['workers'] = len(self._workers)
+        depths = [self._channeldepth(worker.get_ctlqueue()) for worker in self._workers]
+        if depths and (None not in depths):
+            gauges['worker_queued'] = sum(depths)
+            gauges['worker_queued_max'] = max(depths)
+        return gauges
+
+    def _startnode(self, node, sock):
+        entry = self._node_worker.get(node)
+        channel = self._send_dict.get(node)
+        if (entry is None) or (channel is None):
+            return
+        #Pickle now, so the socket can be closed here before the queue feeder thread runs.
+        channel.start(entry[1], bytes(ForkingPickler.dumps(sock)))
+
+    def _releasenode(self, node, connid=None):
+        """Forget the worker of node. Returns the (index, connid) entry or None."""
+        self._lock.acquire()
+        try:
+            entry = self._node_worker.get(node)
+            if (entry is None) or ((connid is not None) and (entry[1] != connid)):
+                return None
+            del self._node_worker[node]
+            self._worker_load[entry[0]] -= 1
+            self._send_dict.pop(node, None)
+            return entry
+        finally:
+            self._lock.release()
+
+    def _nodeclosed(self, node, connid):
+        if self._releasenode(node, connid) is not None:
+            self._delnode(node)
+
+    def _disconnect_and_terminate(self, node):
+        self._delnode(node)
+        entry = self._releasenode(node)
+        if entry is not None:
+            self._workers[entry[0]].get_ctlqueue().put((WORKER_CLOSE, node, entry[1]))
+
+    def _check_process(self):
+        while True:
+            sentinels = {worker.sentinel: index for index, worker in enumerate(self._workers)}
+            for sentinel in mp_connection.wait(list(sentinels)):
+                index = sentinels[sentinel]
+                worker = self._workers[index]
+                worker.join()
+                print('Worker process %d stopped (exitcode %s), restarting.' %(index, worker.exitcode))
+                self._workers[index] = self._startworker(index)
+                for node, entry in list(self._node_worker.items()):
+                    if (entry[0] == index) and (self._releasenode(node, entry[1]) is not None):
+                        self._delnode(node)
@@ -0,0 +1,389 @@
+#!/usr/bin/python3
+"""STARS Server load generator.
+
+Starts the server of PyStars.py on localhost in each requested mode, logs in simulated
+nodes with the key handshake and drives traffic through the server. One
+JSON object per mode and scenario is printed to stdout. Usage:
+
+    python starsload.py [-modes single,multi] [-scenarios p2p,fanout,group,large,stall]
+                        [-nodes 20] [-seconds 5] [-payload 100000] [-json FILE]
+
+Scenarios:
+    p2p     pairs of nodes, request and @reply, one request in flight per pair
+    fanout  one node sends _ChangedValue events to all others via flgon
+    group   one node sends commands to a group of all others; command_allow.cfg
+            allows them for the member names only, not for the group name
+    large   like p2p with payload bytes in every request
+    stall   one node stops reading while another floods it with STALL_BYTES,
+            the other nodes run p2p; fails if a round trip gets no reply
+            within REPLY_TIMEOUT, so one slow node must not stall routing
+
+Mode shm is the multiprocessing server with the shared memory transport.
+
+The node key files are copies of takaserv-lib/term1.key in a temporary
+lib directory, so every simulated node has its own name. The server gets
+all its settings from here, PyStars.cfg is not read.
+"""
+import asyncio
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+import starsutil
+
+SERVERDIR = os.path.dirname(os.path.realpath(__file__))
+LIBDIR = os.path.join(SERVERDIR, 'takaserv-lib')
+KEYFILE = 'term1.key'
+MODES = ('single', 'multi', 'shm', 'async', 'pool')
+#PyStars.py ignores its command line when PyStars.cfg exists, so the server is
+#created with chooseversion() and every parameter given here.
+SERVERCODE = '''import sys
+sys.path.insert(0, sys.argv[1])
+import PyStars
+mode, transport = ('multi', 'shm') if sys.argv[2] == 'shm' else (sys.argv[2], 'queue')
+#mode, port, lib, key, maxline, iponly, workers, assign, transport, metricsport, recorder, recordersize
+stars = PyStars.chooseversion([mode, int(sys.argv[3]), sys.argv[4], None, None, False, None,
+                               'load', transport, None, None, 0])
+if stars.startup():
+    stars.runserver()
+'''
+SCENARIOS = ('p2p', 'fanout', 'group', 'large', 'stall')
+STALL_BYTES = 8388608
+STALL_LINE = 65536
+SERVER_START_TIMEOUT = 20.0
+REPLY_TIMEOUT = 10.0
+LATENCY_SAMPLES = 1000000
+
+class LoadNode:
+    """One simulated STARS client on asyncio streams."""
+    def __init__(self, name):
+        self.name = name
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, port, keys):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port, limit=1 << 24)
+        keynum = int(await self.reader.readline())
+        self.writer.write(('%s %s\n' %(self.name, keys[keynum % len(keys)])).encode())
+        answer = (await self.reader.readline()).decode().strip()
+        if answer != 'System>%s Ok:' %self.name:
+            raise RuntimeError('Login of %s failed: %s' %(self.name, answer))
+
+    def send(self, line):
+        self.writer.write(line.encode() + b'\n')
+
+    async def recv(self):
+        line = await asyncio.wait_for(self.reader.readline(), REPLY_TIMEOUT)
+        if not line:
+            raise RuntimeError('%s: connection closed by server' %self.name)
+        return line.decode().rstrip('\n')
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.write(b'quit\n')
+            self.writer.close()
+            self.writer = None
+
+def makelib(names):
+    """Temporary lib directory with the cfg files of takaserv-lib and one key file per node."""
+    libdir = tempfile.mkdtemp(prefix='starsload-')
+    for filename in os.listdir(LIBDIR):
+        if filename.endswith('.cfg'):
+            shutil.copy(os.path.join(LIBDIR, filename), libdir)
+    for name in names:
+        shutil.copy(os.path.join(LIBDIR, KEYFILE), os.path.join(libdir, name + '.key'))
+    return libdir
+
+def readkeys():
+    with open(os.path.join(LIBDIR, KEYFILE)) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def freeport():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def startserver(mode, port, libdir):
+    """Server in its own process group, so stopserver() also ends the node and worker processes."""
+    cmd = [sys.executable, '-c', SERVERCODE, SERVERDIR, mode, str(port), libdir]
+    server = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('Server exited with %d' %server.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    stopserver(server)
+    raise RuntimeError('Server did not start on port %d' %port)
+
+def _killgroup(server, sig):
+    try:
+        os.killpg(server.pid, sig)
+    except ProcessLookupError:
+        pass
+
+def stopserver(server):
+    _killgroup(server, signal.SIGTERM)
+    try:
+        server.wait(5)
+    except subprocess.TimeoutExpired:
+        pass
+    #Children that outlive the server would keep the output pipe of a caller open.
+    _killgroup(server, signal.SIGKILL)
+    server.wait()
+
+def _children():
+    """Map of parent pid to child pids from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' %entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+def processrss(pid):
+    """Resident set size in kB of pid and all its descendants, None where /proc is not available."""
+    if not os.path.isdir('/proc/%d' %pid):
+        return None
+    children = _children()
+    total = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        pids.extend(children.get(p, ()))
+        try:
+            with open('/proc/%d/status' %p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+async def connectall(nodes, port, keys):
+    """Log in all nodes concurrently and return logins per second."""
+    start = time.perf_counter()
+    await asyncio.gather(*[node.connect(port, keys) for node in nodes])
+    return len(nodes) / (time.perf_counter() - start)
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def _requester(node, peer, body, stats, end):
+    count = 0
+    while time.perf_counter() < end:
+        sent = time.perf_counter()
+        node.send('%s SetValue %d %s' %(peer.name, count, body))
+        await node.recv()
+        stats.add(time.perf_counter() - sent)
+        count += 1
+    return count
+
+async def _responder(node):
+    try:
+        while True:
+            line = await node.recv()
+            #"req>me SetValue n body" is answered with "req @SetValue n"
+            frm, _unused, rest = line.partition(' ')
+            cmd, _unused, rest = rest.partition(' ')
+            node.send('%s @%s %s' %(frm.split('>', 1)[0], cmd, rest.split(' ', 1)[0]))
+    except (RuntimeError, asyncio.TimeoutError, ConnectionError):
+        pass
+
+async def scenario_p2p(nodes, seconds, payload):
+    stats = starsutil.LatencyStats(LATENCY_SAMPLES)
+    pairs = [(nodes[i], nodes[i + 1]) for i in range(0, len(nodes) - 1, 2)]
+    responders = [asyncio.ensure_future(_responder(peer)) for _unused, peer in pairs]
+    body = 'x' * payload if payload else 'v'
+    #One round trip per pair first, so process start up in multi mode is not measured.
+    for node, peer in pairs:
+        node.send('%s GetValue' %peer.name)
+    for node, _unused in pairs:
+        await node.recv()
+    end = time.perf_counter() + seconds
+    start = time.perf_counter()
+    counts = await asyncio.gather(*[_requester(node, peer, body, stats, end) for node, peer in pairs])
+    elapsed = time.perf_counter() - start
+    await _cancel(responders)
+    requests = sum(counts)
+    return {'requests': requests, 'messages': requests * 2, 'throughput': requests * 2 / elapsed,
+            'bytes_per_second': requests * payload / elapsed, 'stats': stats}
+
+async def _subscriber(node, publisher, sent, stats, received, alldone):
+    try:
+        while True:
+            line = await node.recv()
+            if not line.startswith(publisher.name + '>'):
+                continue
+            seq = int(line.rsplit(' ', 1)[1])
+            stats.add(time.perf_counter() - sent[seq])
+            received[seq] = received.get(seq, 0) + 1
+            if received[seq] == alldone[0]:
+                alldone[1].set()
+    except (RuntimeError, asyncio.TimeoutError, ConnectionError):
+        pass
+
+async def _fanout(publisher, subscribers, line, seconds):
+    """Sends line % seq from publisher until every subscriber got it, for seconds."""
+    stats = starsutil.LatencyStats(LATENCY_SAMPLES)
+    sent = {}
+    received = {}
+    alldone = (len(subscribers), asyncio.Event())
+    tasks = [asyncio.ensure_future(_subscriber(node, publisher, sent, stats, received, alldone))
+             for node in subscribers]
+    end = time.perf_counter() + seconds
+    start = time.perf_counter()
+    seq = 0
+    while time.perf_counter() < end:
+        #Next event when every subscriber has the previous one.
+        alldone[1].clear()
+        sent[seq] = time.perf_counter()
+        publisher.send(line %seq)
+        try:
+            await asyncio.wait_for(alldone[1].wait(), REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError('Message %d was not delivered to all subscribers' %seq)
+        seq += 1
+    elapsed = time.perf_counter() - start
+    await _cancel(tasks)
+    delivered = sum(received.values())
+    return {'events': seq, 'messages': delivered, 'throughput': delivered / elapsed, 'stats': stats}
+
+async def scenario_fanout(nodes, seconds):
+    publisher, subscribers = nodes[0], nodes[1:]
+    for node in subscribers:
+        node.send('System flgon %s' %publisher.name)
+        await node.recv()
+    return await _fanout(publisher, subscribers, 'System _ChangedValue %d', seconds)
+
+async def _reloadpermission(node):
+    node.send('System loadpermission')
+    answer = await node.recv()
+    if 'Er:' in answer:
+        raise RuntimeError(answer)
+
+async def scenario_group(nodes, seconds, libdir):
+    publisher, members = nodes[0], nodes[1:]
+    group = 'all' + publisher.name
+    prefix = publisher.name.rstrip('0123456789')
+    allowfile = os.path.join(libdir, starsutil.CMDALLOW)
+    with open(allowfile, 'w') as f:
+        #Lines are stripped when loaded, \s stands for the space after the receiver.
+        f.write('^\\w+>System\\s\n^%s\\d+>%s\\d+\\s\n' %(prefix, prefix))
+    try:
+        await _reloadpermission(publisher)
+        publisher.send('System groupdef %s %s' %(group, ' '.join(node.name for node in members)))
+        await publisher.recv()
+        return await _fanout(publisher, members, group + ' Set %d', seconds)
+    finally:
+        os.remove(allowfile)
+        await _reloadpermission(publisher)
+
+async def scenario_stall(nodes, seconds):
+    stalled, flooder = nodes[0], nodes[1]
+    #Nothing is read from the socket anymore, the server has to keep the lines.
+    stalled.writer.transport.pause_reading()
+    body = 'x' * STALL_LINE
+    lines = STALL_BYTES // STALL_LINE
+    for i in range(lines):
+        flooder.send('%s _Flood %d %s' %(stalled.name, i, body))
+        await flooder.writer.drain()
+    result = await scenario_p2p(nodes[2:], seconds, 0)
+    result['flooded_bytes'] = lines * STALL_LINE
+    return result
+
+async def runscenario(name, mode, port, keys, nodecount, seconds, payload, libdir):
+    nodes = [LoadNode('%s%d' %(name, i)) for i in range(nodecount)]
+    connect_rate = await connectall(nodes, port, keys)
+    if name == 'fanout':
+        result = await scenario_fanout(nodes, seconds)
+    elif name == 'group':
+        result = await scenario_group(nodes, seconds, libdir)
+    elif name == 'stall':
+        result = await scenario_stall(nodes, seconds)
+    else:
+        result = await scenario_p2p(nodes, seconds, payload if name == 'large' else 0)
+    stats = result.pop('stats')
+    result.update({
+        'mode': mode,
+        'scenario': name,
+        'nodes': nodecount,
+        'seconds': seconds,
+        'connect_rate': connect_rate,
+        'p50_ms': stats.percentile(50) * 1000,
+        'p99_ms': stats.percentile(99) * 1000,
+        'max_ms': stats.maximum * 1000,
+    })
+    for node in nodes:
+        await node.close()
+    return result
+
+def runmode(mode, scenarios, nodecount, seconds, payload):
+    names = ['%s%d' %(name, i) for name in scenarios for i in range(nodecount)]
+    libdir = makelib(names)
+    port = freeport()
+    server = startserver(mode, port, libdir)
+    loop = asyncio.new_event_loop()
+    results = []
+    try:
+        keys = readkeys()
+        for name in scenarios:
+            result = loop.run_until_complete(runscenario(name, mode, port, keys, nodecount, seconds, payload, libdir))
+            result['server_rss_kb'] = processrss(server.pid)
+            results.append(result)
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
+    finally:
+        loop.close()
+        stopserver(server)
+        shutil.rmtree(libdir, ignore_errors=True)
+    return results
+
+def main(argv=None):
+    parser = ArgumentParser(description='STARS Server load generator.')
+    parser.add_argument('-modes', default='single,multi', help='Server modes, comma separated: %s.' %', '.join(MODES))
+    parser.add_argument('-scenarios', default=','.join(SCENARIOS), help='Scenarios, comma separated: %s.' %', '.join(SCENARIOS))
+    parser.add_argument('-nodes', type=int, default=20, help='Simulated nodes per scenario (at least 2, 4 for stall).')
+    parser.add_argument('-seconds', type=float, default=5.0, help='Duration of each scenario.')
+    parser.add_argument('-payload', type=int, default=100000, help='Payload bytes per request in the large scenario.')
+    parser.add_argument('-json', dest='jsonfile', default=None, help='Write all results as a JSON list to this file.')
+    args = parser.parse_args(argv)
+    modes = args.modes.split(',')
+    scenarios = args.scenarios.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('Unknown mode: %s' %mode)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario: %s' %name)
+    if args.nodes < 2:
+        parser.error('At least 2 nodes are required.')
+    if ('stall' in scenarios) and (args.nodes < 4):
+        parser.error('At least 4 nodes are required for the stall scenario.')
+    results = []
+    for mode in modes:
+        results.extend(runmode(mode, scenarios, args.nodes, args.seconds, args.payload))
+    if args.jsonfile:
+        with open(args.jsonfile, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+""" STARS Server metrics module.
+
+Counters and histograms of a server. Updating them is a plain integer or
+dict increment in the routing thread, so they are always on. Text for
+System stats and for the optional metrics endpoint is only built on
+request. The endpoint serves the Prometheus text format on localhost.
+Profiler wraps cProfile for System profile.
+"""
+
+import time
+import threading
+import cProfile
+import pstats
+from pathlib import Path
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import starsutil
+
+HIST_BUCKETS = 24
+METRICS_HOST = '127.0.0.1'
+METRICS_TIMEOUT = 2.0
+PROFILE_FILE = 'stars-profile'
+PROFILE_LINES = 50
+
+class Histogram:
+    """Durations in log2 buckets of microseconds. Bucket i counts the samples
+    below 2**i us, the last bucket everything above."""
+    __slots__ = ('count', 'total', 'buckets')
+
+    def __init__(self, nbuckets=HIST_BUCKETS):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * nbuckets
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        i = int(seconds * 1000000).bit_length()
+        if i >= len(self.buckets):
+            i = len(self.buckets) - 1
+        self.buckets[i] += 1
+
+    def bound(self, i):
+        """Upper bound of bucket i in seconds."""
+        return (1 << i) / 1000000.0
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return self.bound(i)
+        return self.bound(len(self.buckets) - 1)
+
+    def summary(self):
+        avg = self.total / self.count if self.count else 0.0
+        return "count=%d avg=%.1fus p50<%.0fus p99<%.0fus" %(self.count, avg * 1000000,
+            self.percentile(50) * 1000000, self.percentile(99) * 1000000)
+
+class Metrics:
+    """Counters of one server.
+
+    msgs_in/bytes_in count the lines received from nodes, msgs_out/bytes_out
+    the lines queued for sending (copies for the Debugger node excluded).
+    node_in/node_out hold the same message counts per node name. route is
+    the time to route one received line.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.msgs_in = 0
+        self.bytes_in = 0
+        self.msgs_out = 0
+        self.bytes_out = 0
+        self.denied = 0
+        self.handshakes = 0
+        self.handshake_failed = 0
+        self.tap_dropped = 0
+        self.overflow_dropped = 0
+        self.node_in = Counter()
+        self.node_out = Counter()
+        self.route = Histogram()
+
+    def summary(self, gauges):
+        """One line for System stats. gauges is a dict of current values from the server."""
+        items = [('uptime', '%.0f' %(time.time() - self.started))]
+        items.extend(gauges.items())
+        items.extend([('msgs_in', self.msgs_in), ('msgs_out', self.msgs_out),
+                      ('bytes_in', self.bytes_in), ('bytes_out', self.bytes_out),
+                      ('denied', self.denied), ('handshakes', self.handshakes),
+                      ('handshake_failed', self.handshake_failed), ('tap_dropped', self.tap_dropped),
+                      ('overflow_dropped', self.overflow_dropped)])
+        return "%s route: %s" %(' '.join('%s=%s' %item for item in items), self.route.summary())
+
+    def nodesummary(self, node, pending):
+        return "%s msgs_in=%d msgs_out=%d pending=%s" %(node, self.node_in[node], self.node_out[node], pending)
+
+    def exposition(self, gauges, nodegauges):
+        """Prometheus text format. nodegauges maps a gauge name to a dict of node values."""
+        lines = []
+        def metric(name, kind, value, helptext):
+            lines.append('# HELP stars_%s %s' %(name, helptext))
+            lines.append('# TYPE stars_%s %s' %(name, kind))
+            if isinstance(value, dict):
+                for node, v in sorted(value.items()):
+                    lines.append('stars_%s{node="%s"} %s' %(name, node, v))
+            else:
+                lines.append('stars_%s %s' %(name, value))
+        metric('uptime_seconds', 'gauge', '%.3f' %(time.time() - self.started), 'Seconds since the server has started.')
+        for name, value in gauges.items():
+            metric(name, 'gauge', value, 'Current %s.' %name.replace('_', ' '))
+        for name, values in nodegauges.items():
+            metric('node_' + name, 'gauge', dict(values), 'Current %s per node.' %name.replace('_', ' '))
+        metric('messages_in_total', 'counter', self.msgs_in, 'Lines received from nodes.')
+        metric('messages_out_total', 'counter', self.msgs_out, 'Lines queued for nodes.')
+        metric('bytes_in_total', 'counter', self.bytes_in, 'Bytes received from nodes.')
+        metric('bytes_out_total', 'counter', self.bytes_out, 'Bytes queued for nodes.')
+        metric('denied_total', 'counter', self.denied, 'Commands and events denied by the command permission.')
+        metric('handshakes_total', 'counter', self.handshakes, 'Successful logins.')
+        metric('handshake_failed_total', 'counter', self.handshake_failed, 'Failed logins and rejected hosts.')
+        metric('tap_dropped_total', 'counter', self.tap_dropped, 'Lines not copied to a tap because its buffer was full.')
+        metric('overflow_dropped_total', 'counter', self.overflow_dropped, 'Send chunks dropped when a node that did not read was disconnected.')
+        metric('node_messages_in_total', 'counter', dict(self.node_in), 'Lines received per node.')
+        metric('node_messages_out_total', 'counter', dict(self.node_out), 'Lines queued per node.')
+        hist = self.route
+        lines.append('# HELP stars_route_seconds Time to route one received line.')
+        lines.append('# TYPE stars_route_seconds histogram')
+        buckets = list(hist.buckets)
+        seen = 0
+        for i, n in enumerate(buckets[:-1]):
+            seen += n
+            lines.append('stars_route_seconds_bucket{le="%g"} %d' %(hist.bound(i), seen))
+        lines.append('stars_route_seconds_bucket{le="+Inf"} %d' %sum(buckets))
+        lines.append('stars_route_seconds_sum %.6f' %hist.total)
+        lines.append('stars_route_seconds_count %d' %sum(buckets))
+        return '\n'.join(lines) + '\n'
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class MetricsEndpoint:
+    """HTTP endpoint on localhost that answers every GET with render()."""
+    def __init__(self, port, render, host=METRICS_HOST):
+        self._port = port
+        self._host = host
+        self._render = render
+        self._httpd = None
+
+    def start(self):
+        render = self._render
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    body = render().encode()
+                except Exception as ex:
+                    self.send_error(500, str(ex))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        try:
+            self._httpd = _ThreadingHTTPServer((self._host, self._port), Handler)
+        except Exception as ex:
+            print('Can\'t create metrics endpoint! ', ex)
+            return False
+        thread = threading.Thread(target=self._httpd.serve_forever, name='Metrics')
+        thread.daemon = True
+        thread.start()
+        print('Metrics endpoint: http://%s:%d/metrics' %(self._host, self._port))
+        return True
+
+def callinloop(callsoon, func):
+    """Run func in a server loop through callsoon and wait for its result. Returns None on timeout."""
+    done = threading.Event()
+    result = []
+    def call():
+        try:
+            result.append(func())
+        finally:
+            done.set()
+    callsoon(call)
+    done.wait(METRICS_TIMEOUT)
+    return result[0] if result else None
+
+class Profiler:
+    """cProfile of the routing thread, switched by System profile start|stop|dump.
+
+    cProfile only sees the thread that has called start(), so all methods
+    must be called from the thread that routes the messages. There is no
+    overhead while the profiler is stopped.
+    """
+    def __init__(self):
+        self._profile = None
+        self.running = False
+
+    def start(self):
+        """Start a new profile. Returns False if it is running already."""
+        if self.running:
+            return False
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.running = True
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self._profile.disable()
+        self.running = False
+        return True
+
+    def dump(self, libdir):
+        """Write the stats so far to the lib directory: .prof for pstats and
+        a .txt with the top functions by cumulative time. Every dump replaces
+        the previous one. Returns the file name without extension, None if no
+        profile has been started."""
+        if self._profile is None:
+            return None
+        path = Path(starsutil.SERVERDIR, libdir, PROFILE_FILE)
+        try:
+            #Stats() disables the profiler.
+            stats = pstats.Stats(self._profile)
+            stats.dump_stats(str(path) + '.prof')
+            with open(str(path) + '.txt', 'w') as f:
+                stats.stream = f
+                stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        finally:
+            if self.running:
+                self._profile.enable()
+        return path.name
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+"""STARS Server traffic flight recorder.
+
+The server writes one compact record per routed line into a fixed size
+circular file that is memory-mapped, so recording is a struct pack and a
+copy into the page cache; writing to disk is left to the OS. The oldest
+records are overwritten. A record holds the time, the direction, the
+sender and receiver node, the length of the line and its first
+RECORD_BODY bytes.
+
+The records hold the start of the message bodies, which may contain
+values or settings that should not be readable by everyone. The ring
+file is created readable by the server user only (mode 0600). The
+recorder is off unless a size is given.
+
+Run as a script to dump the records of a ring file:
+
+    python starsrecorder.py FILE [-node NAME] [-from NAME] [-to NAME]
+                                 [-last SECONDS] [-grep REGEX] [-json]
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import struct
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+import starsutil
+
+RECORDER_FILE = 'stars-recorder.ring'
+RECORDER_SIZE = 0
+RECORD_BODY = 48
+MAGIC = b'STARSREC'
+VERSION = 1
+
+#Kinds of records
+REC_IN = 0
+REC_OUT = 1
+KINDNAMES = ('in', 'out')
+
+#Header: magic, version, data size, head, tail, record count.
+_HEADER = struct.Struct('<8sIxxxxQQQQ')
+_HEADERSIZE = 64
+_POS = struct.Struct('<QQQ')
+_POSOFFSET = 24
+#Record: length, kind, length of from, length of to, time, length of the line.
+_REC = struct.Struct('<HBBBdI')
+_RECLEN = struct.Struct('<H')
+
+class Recorder:
+    """Writer of a ring file. With threadsafe record() may be called from several threads."""
+    def __init__(self, filename, size, threadsafe=True):
+        self._filename = str(filename)
+        self._lock = threading.Lock() if threadsafe else None
+        fd = os.open(self._filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            header = os.read(fd, _HEADERSIZE)
+            valid = False
+            if len(header) == _HEADERSIZE:
+                magic, version, oldsize = _HEADER.unpack_from(header)[:3]
+                valid = (magic == MAGIC) and (version == VERSION) and (oldsize == size)\
+                    and (os.fstat(fd).st_size == _HEADERSIZE + size)
+            if not valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, _HEADERSIZE + size)
+            self._mm = mmap.mmap(fd, _HEADERSIZE + size)
+        finally:
+            os.close(fd)
+        if not valid:
+            _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, size, 0, 0, 0)
+        self._size = size
+        self._head, self._tail, self._count = _POS.unpack_from(self._mm, _POSOFFSET)
+
+    def get_filename(self):
+        return self._filename
+
+    def record(self, kind, frm, to, data, length=None):
+        """Record one line. data is the str or bytes of the line, only its start is kept.
+        With length data may be only the start of a line of that length."""
+        body = data[:RECORD_BODY]
+        if isinstance(body, str):
+            body = body.encode('utf8', 'replace')[:RECORD_BODY]
+        frm = frm.encode()[:255]
+        to = to.encode()[:255]
+        rec = _REC.pack(_REC.size + len(frm) + len(to) + len(body), kind, len(frm), len(to),
+                        time.time(), len(data) if length is None else length) + frm + to + body
+        if self._lock is None:
+            self._write(rec)
+        else:
+            with self._lock:
+                self._write(rec)
+
+    def _write(self, rec):
+        n = len(rec)
+        head = self._head
+        if (self._size - head < n) or (self._count and (head <= self._tail < head + n)):
+            self._reserve(n)
+            head = self._head
+        self._mm[_HEADERSIZE + head:_HEADERSIZE + head + n] = rec
+        self._head = head + n
+        self._count += 1
+        _POS.pack_into(self._mm, _POSOFFSET, self._head, self._tail, self._count)
+
+    def _reserve(self, n):
+        """Make room for n bytes at head by dropping the oldest records."""
+        if self._size - self._head < n:
+            if self._tail >= self._head:
+                #The oldest records are in the part that is given up.
+                while self._count and not self._droptail():
+                    pass
+            #Wrap, a zero length marks the rest of the data area as unused.
+            if self._size - self._head >= _RECLEN.size:
+                _RECLEN.pack_into(self._mm, _HEADERSIZE + self._head, 0)
+            self._head = 0
+        while self._count and (self._head <= self._tail < self._head + n):
+            self._droptail()
+        if not self._count:
+            self._tail = self._head
+
+    def _droptail(self):
+        """Drop the oldest record. Returns True if tail has wrapped to the start."""
+        self._tail += _RECLEN.unpack_from(self._mm, _HEADERSIZE + self._tail)[0]
+        self._count -= 1
+        if _wrapped(self._mm, self._size, self._tail):
+            self._tail = 0
+            return True
+        return False
+
+    def close(self):
+        self._mm.close()
+
+def _wrapped(buf, size, pos):
+    return (size - pos < _RECLEN.size) or (_RECLEN.unpack_from(buf, _HEADERSIZE + pos)[0] == 0)
+
+def open_recorder(filename, libdir, sizemb=RECORDER_SIZE, threadsafe=True):
+    """Recorder for filename relative to the lib directory, None if sizemb is 0 or the file can not be used."""
+    if not filename or not sizemb:
+        return None
+    path = Path(starsutil.SERVERDIR, libdir, filename)
+    try:
+        recorder = Recorder(path, sizemb * 1048576, threadsafe)
+    except Exception as ex:
+        print('Can\'t open flight recorder file! ', path, ex)
+        return None
+    print('Flight recorder: %s, %d MB.' %(path, sizemb))
+    return recorder
+
+def readrecords(filename):
+    """Records of a ring file from the oldest to the newest as
+    (time, kind, from, to, length, body) tuples."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, size, head, tail, count = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('%s is not a flight recorder file.' %filename)
+    if version != VERSION:
+        raise ValueError('Unknown flight recorder version %d.' %version)
+    records = []
+    pos = tail
+    for _unused in range(count):
+        if _wrapped(data, size, pos):
+            pos = 0
+        reclen, kind, frmlen, tolen, t, length = _REC.unpack_from(data, _HEADERSIZE + pos)
+        start = _HEADERSIZE + pos + _REC.size
+        frm = data[start:start + frmlen].decode('utf8', 'replace')
+        to = data[start + frmlen:start + frmlen + tolen].decode('utf8', 'replace')
+        body = data[start + frmlen + tolen:_HEADERSIZE + pos + reclen].decode('utf8', 'replace')
+        records.append((t, kind, frm, to, length, body))
+        pos += reclen
+    return records
+
+def formatrecord(rec):
+    t, kind, frm, to, length, body = rec
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)) + ('%.6f' %(t % 1))[1:]
+    if kind == REC_IN:
+        return '%s in  %s>%s %d %s' %(stamp, frm, to, length, body.rstrip('\n'))
+    return '%s out %s %d %s' %(stamp, to, length, body.rstrip('\n'))
+
+def main(argv=None):
+    parser = ArgumentParser(description='Dump a STARS flight recorder file.')
+    parser.add_argument('file', help='Ring file, for example %s in the lib directory.' %RECORDER_FILE)
+    parser.add_argument('-node', default=None, help='Only records from or to this node.')
+    parser.add_argument('-from', dest='frm', default=None, help='Only lines received from this node.')
+    parser.add_argument('-to', default=None, help='Only lines for this node.')
+    parser.add_argument('-last', type=float, default=None, help='Only the last SECONDS before the newest record.')
+    parser.add_argument('-grep', default=None, help='Only records whose line start matches this regex.')
+    parser.add_argument('-json', action='store_true', help='One JSON object per record.')
+    args = parser.parse_args(argv)
+    try:
+        records = readrecords(args.file)
+    except (OSError, ValueError, struct.error) as ex:
+        print(ex)
+        return 1
+    pattern = re.compile(args.grep) if args.grep else None
+    since = records[-1][0] - args.last if (records and args.last is not None) else None
+    for rec in records:
+        t, kind, frm, to, length, body = rec
+        if (since is not None) and (t < since):
+            continue
+        if (args.node is not None) and (args.node not in (frm, to)):
+            continue
+        if (args.frm is not None) and ((kind != REC_IN) or (frm != args.frm)):
+            continue
+        if (args.to is not None) and (to != args.to):
+            continue
+        if (pattern is not None) and not pattern.search(body):
+            continue
+        if args.json:
+            print(json.dumps({'time': t, 'kind': KINDNAMES[kind], 'from': frm, 'to': to,
+                              'length': length, 'body': body}))
+        else:
+            print(formatrecord(rec))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
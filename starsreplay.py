@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+"""STARS Server traffic replay.
+
+Replays captured traffic against PyStars.py on localhost and reports the
+latency and throughput the server achieved. Usage:
+
+    python starsreplay.py LOG [-mode single] [-port PORT] [-speed 1.0]
+                              [-limit N] [-json FILE]
+
+LOG is one of:
+    a flight recorder ring file (stars-recorder.ring), the received lines
+        are replayed; lines longer than the recorded start are padded
+    the text dump of starsrecorder.py, "in" lines are replayed
+    a Debugger transcript, one "from>to message" line each, optionally
+        starting with a "YYYY-mm-dd HH:MM:SS.ffffff" time stamp
+
+Every node that sends or receives in the log is logged in with its own
+copy of takaserv-lib/term1.key, as in starsload.py. Without -port a
+server is started in the given mode with a temporary lib directory; with
+-port a running server is used and must accept the node names and keys.
+The temporary lib directory has no aliases, the log holds the names as
+the nodes have sent them.
+-speed 2 replays twice as fast as recorded, -speed 0 as fast as
+possible (also used for logs without time stamps).
+
+A Debugger transcript shows an event once per subscriber, it is replayed
+as direct messages. Lines from System and _Connected/_Disconnected
+events generated by the server are skipped.
+"""
+import asyncio
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from argparse import ArgumentParser
+from collections import deque
+from datetime import datetime
+import starsutil
+import starsrecorder
+import starsload
+
+LATENCY_SAMPLES = 1000000
+DRAIN_TIMEOUT = 5.0
+ALIASFILE = 'aliases.cfg'
+SERVER_EVENTS = ('_Connected', '_Disconnected')
+_STAMP = re.compile(r"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)\s+(.*)$")
+_DUMPIN = re.compile(r"in\s+(\S+) (\d+) ?(.*)$")
+
+class ReplayMessage:
+    __slots__ = ('time', 'sender', 'line', 'key', 'expect')
+
+    def __init__(self, t, sender, line, key, expect):
+        self.time = t
+        self.sender = sender
+        self.line = line
+        self.key = key
+        self.expect = expect
+
+def _message(t, frm, to, body):
+    """ReplayMessage for a line frm>to body, None for lines the server generates."""
+    if (not frm) or (not to):
+        return None
+    sender = frm.split('.', 1)[0]
+    if (sender == 'System') or (body in SERVER_EVENTS):
+        return None
+    line = '%s %s' %(to, body) if frm == sender else '%s>%s %s' %(frm, to, body)
+    tonode = to.split('.', 1)[0]
+    #Delivered as "frm>to body" to tonode, matched in order per sender and receiver.
+    key = (frm, tonode) if tonode != 'System' else None
+    return ReplayMessage(t, sender, line, key, '%s>%s %s' %(frm, to, body))
+
+def _padded(body, length):
+    if len(body) < length:
+        return body + 'x' * (length - len(body))
+    return body
+
+def _parsestamp(stamp):
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in stamp else '%Y-%m-%d %H:%M:%S'
+    return datetime.strptime(stamp, fmt).timestamp()
+
+def loadring(filename):
+    msgs = []
+    for t, kind, frm, to, length, body in starsrecorder.readrecords(filename):
+        if kind == starsrecorder.REC_IN:
+            msg = _message(t, frm, to, _padded(body, length))
+            if msg is not None:
+                msgs.append(msg)
+    return msgs
+
+def loadtext(filename):
+    msgs = []
+    with open(filename, errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            t = None
+            m = _STAMP.match(line)
+            if m:
+                t = _parsestamp(m.group(1))
+                line = m.group(2)
+                dump = _DUMPIN.match(line)
+                if dump:
+                    #starsrecorder.py dump: "in from>to length body"
+                    line = '%s %s' %(dump.group(1), _padded(dump.group(3), int(dump.group(2))))
+                elif line.startswith('out '):
+                    continue
+            frm, to, _unused, body, _kind = starsutil.parse_message(line)
+            msg = _message(t, frm, to, body)
+            if msg is not None:
+                msgs.append(msg)
+    return msgs
+
+def loadlog(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(len(starsrecorder.MAGIC))
+    if magic == starsrecorder.MAGIC:
+        return loadring(filename)
+    return loadtext(filename)
+
+def nodenames(msgs):
+    names = set()
+    for msg in msgs:
+        names.add(msg.sender)
+        if msg.key is not None:
+            names.add(msg.key[1])
+    return sorted(names)
+
+async def _receiver(node, pending, stats, counts):
+    try:
+        while True:
+            #No timeout, a log may have long pauses.
+            line = await node.reader.readline()
+            if not line:
+                return
+            line = line.decode('utf8', 'replace').rstrip('\n')
+            waiting = pending.get((line.split('>', 1)[0], node.name))
+            #Events and replies of System are not replayed lines, copies for a Debugger node are
+            #addressed to others.
+            if waiting and (waiting[0][0] == line):
+                stats.add(time.perf_counter() - waiting.popleft()[1])
+                counts[0] += 1
+    except ConnectionError:
+        pass
+
+async def replay(msgs, port, speed):
+    names = nodenames(msgs)
+    nodes = {name: starsload.LoadNode(name) for name in names}
+    connect_rate = await starsload.connectall(list(nodes.values()), port, starsload.readkeys())
+    stats = starsutil.LatencyStats(LATENCY_SAMPLES)
+    pending = {}
+    counts = [0]
+    #One round trip per node first, so process start up in multi mode is not measured.
+    for node in nodes.values():
+        node.send('System hello')
+    for node in nodes.values():
+        while ' @hello ' not in await node.recv():
+            pass
+    receivers =[asyncio.ensure_future(_receiver(node, pending, stats, counts)) for node in nodes.values()]
+    first = next((msg.time for msg in msgs if msg.time is not None), None)
+    timed = speed and (first is not None)
+    start = time.perf_counter()
+    maxlag = 0.0
+    expected = 0
+    for i, msg in enumerate(msgs):
+        if timed and (msg.time is not None):
+            due = start + (msg.time - first) / speed
+            now = time.perf_counter()
+            if due > now:
+                await asyncio.sleep(due - now)
+            else:
+                maxlag = max(maxlag, now - due)
+        elif (i % 100) == 0:
+            #Let the receivers run and wait for full socket buffers.
+            await nodes[msg.sender].writer.drain()
+            await asyncio.sleep(0)
+        if msg.key is not None:
+            pending.setdefault(msg.key, deque()).append((msg.expect, time.perf_counter()))
+            expected += 1
+        nodes[msg.sender].send(msg.line)
+    sent = time.perf_counter()
+    deadline = sent + DRAIN_TIMEOUT
+    while (counts[0] < expected) and (time.perf_counter() < deadline):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    await starsload._cancel(receivers)
+    for node in nodes.values():
+        await node.close()
+    return {
+        'nodes': len(nodes),
+        'messages': len(msgs),
+        'expected': expected,
+        'delivered': counts[0],
+        'seconds': elapsed,
+        'throughput': counts[0] / elapsed if elapsed else 0.0,
+        'send_rate': len(msgs) / (sent - start) if sent > start else 0.0,
+        'max_lag_ms': maxlag * 1000,
+        'connect_rate': connect_rate,
+        'p50_ms': stats.percentile(50) * 1000,
+        'p99_ms': stats.percentile(99) * 1000,
+        'max_ms': stats.maximum * 1000,
+    }
+
+def main(argv=None):
+    parser = ArgumentParser(description='Replay captured STARS traffic against a local server.')
+    parser.add_argument('log', help='Flight recorder file, its text dump or a Debugger transcript.')
+    parser.add_argument('-mode', default='single', choices=starsload.MODES, help='Server mode to start.')
+    parser.add_argument('-port', type=int, default=None, help='Use the server running on this localhost port.')
+    parser.add_argument('-speed', type=float, default=1.0, help='Replay speed factor, 0 as fast as possible.')
+    parser.add_argument('-limit', type=int, default=None, help='Replay only the first N messages.')
+    parser.add_argument('-json', dest='jsonfile', default=None, help='Write the result to this file.')
+    args = parser.parse_args(argv)
+    try:
+        msgs = loadlog(args.log)
+    except (OSError, ValueError) as ex:
+        print(ex)
+        return 1
+    if args.limit:
+        msgs = msgs[:args.limit]
+    if not msgs:
+        print('No messages to replay in %s.' %args.log)
+        return 1
+    names = nodenames(msgs)
+    server = libdir = None
+    port = args.port
+    if port is None:
+        libdir = starsload.makelib(names)
+        #The log has the names before alias resolution, the example aliases would merge nodes.
+        open(os.path.join(libdir, ALIASFILE), 'w').close()
+        port = starsload.freeport()
+        server = starsload.startserver(args.mode, port, libdir)
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(replay(msgs, port, args.speed))
+    finally:
+        loop.close()
+        if server is not None:
+            starsload.stopserver(server)
+            shutil.rmtree(libdir, ignore_errors=True)
+    result.update({'log': args.log, 'mode': args.mode if args.port is None else None, 'speed': args.speed})
+    print(json.dumps(result, sort_keys=True))
+    if args.jsonfile:
+        with open(args.jsonfile, 'w') as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
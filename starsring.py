@@ -0,0 +1,271 @@
+""" STARS Server shared memory ring module.
+
+Single producer / single consumer byte ring in multiprocessing.shared_memory
+for the messages between the server process and the node processes. A
+record is a 4 byte length followed by the payload; messages longer than a
+quarter of the ring are split into several records. The consumer sleeps on
+a pipe which the producer only writes to when the consumer has announced
+that it is waiting.
+"""
+
+import struct
+import time
+import threading
+import queue
+import multiprocessing as mp
+from collections import deque
+try:
+    from multiprocessing import shared_memory
+    HAS_SHM = True
+except ImportError:
+    #Python < 3.8
+    HAS_SHM = False
+
+RING_SIZE = 262144
+RING_WAIT = 0.1
+#Largest message that put(block=False) can write into an empty ring.
+PUT_SIZE = RING_SIZE // 2
+
+#Header fields on separate cache lines: head is written by the producer,
+#tail and waiting by the consumer, closed by the owner.
+_HEAD = 0
+_TAIL = 64
+_WAITING = 128
+_CLOSED = 132
+_DATA = 192
+_U64 = struct.Struct('Q')
+_U32 = struct.Struct('I')
+_MORE = 0x80000000
+
+class RingClosedError(Exception):
+    pass
+
+class ShmRing:
+    """Byte ring in shared memory. Created by the server process, passed to
+    a spawned process as an argument and attached there by name."""
+
+    def __init__(self, size=RING_SIZE):
+        self._size = size
+        self._shm = shared_memory.SharedMemory(create=True, size=_DATA + size)
+        self._owner = True
+        self._wake_r, self._wake_w = mp.Pipe(duplex=False)
+        self._setup()
+
+    def _setup(self):
+        self._buf = self._shm.buf
+        self._chunk = self._size // 4 - _U32.size
+        self._head = _U64.unpack_from(self._buf, _HEAD)[0]
+        self._tail = _U64.unpack_from(self._buf, _TAIL)[0]
+        self._partial = bytearray()
+
+    def __getstate__(self):
+        return (self._shm.name, self._size, self._wake_r, self._wake_w)
+
+    def __setstate__(self, state):
+        name, self._size, self._wake_r, self._wake_w = state
+        self._shm = _attach(name)
+        self._owner = False
+        self._setup()
+
+    def get_waiter(self):
+        """Connection for multiprocessing.connection.wait()."""
+        return self._wake_r
+
+    def closed(self):
+        return (self._buf is None) or (_U32.unpack_from(self._buf, _CLOSED)[0] != 0)
+
+    def close(self):
+        """Mark the ring closed for both sides and release the memory."""
+        if self._buf is None:
+            return
+        _U32.pack_into(self._buf, _CLOSED, 1)
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def put(self, data, block=True):
+        """Write one message; blocks while the ring is full. Raises RingClosedError,
+        and queue.Full if block is False and the message does not fit now."""
+        view = memoryview(data)
+        total = len(view)
+        if not block:
+            records = max(1, -(-total // self._chunk))
+            if self._size - (self._head - _U64.unpack_from(self._buf, _TAIL)[0]) < total + records * _U32.size:
+                raise queue.Full
+        start = 0
+        while True:
+            n = min(total - start, self._chunk)
+            more = (start + n) < total
+            self._putrecord(view[start:start + n], n | _MORE if more else n)
+            start += n
+            if not more:
+                break
+        if _U32.unpack_from(self._buf, _WAITING)[0]:
+            try:
+                self._wake_w.send_bytes(b'')
+            except OSError:
+                pass
+
+    def _putrecord(self, view, header):
+        need = _U32.size + len(view)
+        delay = 0.0001
+        while self._size - (self._head - _U64.unpack_from(self._buf, _TAIL)[0]) < need:
+            if self.closed():
+                raise RingClosedError('Ring is closed.')
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+        pos = self._copyin(self._head, _U32.pack(header))
+        self._copyin(pos, view)
+        self._head += need
+        _U64.pack_into(self._buf, _HEAD, self._head)
+
+    def _copyin(self, pos, data):
+        offset = pos % self._size
+        n = len(data)
+        first = min(n, self._size - offset)
+        self._buf[_DATA + offset:_DATA + offset + first] = data[:first]
+        if first < n:
+            self._buf[_DATA:_DATA + n - first] = data[first:]
+        return pos + n
+
+    def _copyout(self, pos, n):
+        offset = pos % self._size
+        first = min(n, self._size - offset)
+        data = bytes(self._buf[_DATA + offset:_DATA + offset + first])
+        if first < n:
+            data += bytes(self._buf[_DATA:_DATA + n - first])
+        return data
+
+    def get_all(self):
+        """Return all complete messages in the ring as a list of bytes."""
+        if self._buf is None:
+            return []
+        head = _U64.unpack_from(self._buf, _HEAD)[0]
+        tail = self._tail
+        msgs = []
+        while tail < head:
+            header = _U32.unpack(self._copyout(tail, _U32.size))[0]
+            n = header & ~_MORE
+            data = self._copyout(tail + _U32.size, n)
+            tail += _U32.size + n
+            if header & _MORE:
+                self._partial += data
+                continue
+            if self._partial:
+                data = bytes(self._partial) + data
+                self._partial.clear()
+            msgs.append(data)
+        if tail != self._tail:
+            self._tail = tail
+            _U64.pack_into(self._buf, _TAIL, tail)
+        return msgs
+
+    def prepare_wait(self):
+        """Announce that the consumer will sleep. Returns False if data arrived meanwhile."""
+        _U32.pack_into(self._buf, _WAITING, 1)
+        if _U64.unpack_from(self._buf, _HEAD)[0] != self._tail:
+            _U32.pack_into(self._buf, _WAITING, 0)
+            return False
+        return True
+
+    def end_wait(self):
+        if self._buf is None:
+            return
+        _U32.pack_into(self._buf, _WAITING, 0)
+        try:
+            while self._wake_r.poll():
+                self._wake_r.recv_bytes()
+        except (OSError, EOFError):
+            pass
+
+    def wait(self, timeout=RING_WAIT):
+        """Sleep until the producer writes. The timeout covers a lost wakeup."""
+        if self.prepare_wait():
+            self._wake_r.poll(timeout)
+        self.end_wait()
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        #Python < 3.13: spawned processes share the resource tracker of the
+        #server, the segment is registered only once.
+        return shared_memory.SharedMemory(name=name)
+
+class RingChannel:
+    """mp.Queue replacement on top of a ShmRing for message objects.
+
+    put() may be called from several threads of the producer process,
+    get()/get_nowait() from the consumer process only. Only the data of a
+    message is transported, msgtype(fromnode, data) rebuilds the message
+    on the consumer side. A list of lines is sent as one record joined by
+    newlines, data None as an empty record.
+    """
+
+    def __init__(self, msgtype, fromnode=None, size=RING_SIZE):
+        self._ring = ShmRing(size)
+        self._msgtype = msgtype
+        self._fromnode = fromnode
+        self._lock = threading.Lock()
+        self._msgs = deque()
+
+    def __getstate__(self):
+        return (self._ring, self._msgtype, self._fromnode)
+
+    def __setstate__(self, state):
+        self._ring, self._msgtype, self._fromnode = state
+        self._lock = threading.Lock()
+        self._msgs = deque()
+
+    def get_waiter(self):
+        return self._ring.get_waiter()
+
+    def put(self, msg, block=True):
+        data = msg.get_data()
+        if data is None:
+            data = b''
+        elif isinstance(data, list):
+            data = '\n'.join(data)
+        if isinstance(data, str):
+            data = data.encode()
+        with self._lock:
+            if self._ring.closed():
+                return
+            try:
+                self._ring.put(data, block)
+            except RingClosedError:
+                pass
+
+    def put_nowait(self, msg):
+        self.put(msg, False)
+
+    def get_all(self):
+        return [data or None for data in self._ring.get_all()]
+
+    def prepare_wait(self):
+        return self._ring.prepare_wait()
+
+    def end_wait(self):
+        self._ring.end_wait()
+
+    def get(self, block=True):
+        while not self._msgs:
+            self._msgs.extend(self._ring.get_all())
+            if self._msgs:
+                break
+            if not block:
+                raise queue.Empty
+            if self._ring.closed():
+                raise EOFError('Ring is closed.')
+            self._ring.wait()
+        return self._msgtype(self._fromnode, self._msgs.popleft() or None)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def close(self):
+        with self._lock:
+            self._ring.close()
@@ -10,9 +10,18 @@ import random
 import socket
 import re
 import time
+import threading
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import functools
+import fnmatch
+from collections import deque
 import starsfile
 
-TCP_BUFFER_SIZE = 512
+TCP_BUFFER_SIZE = 65536
+MAX_LINE_LENGTH = 1048576
+CMDPERM_CACHE_SIZE = 4096
 RNDMAX = 10000
 HOSTLIST = 'allow.cfg'
 ALIASES = 'aliases.cfg'
@@ -20,6 +29,36 @@ CMDDENY = 'command_deny.cfg'
 CMDALLOW = 'command_allow.cfg'
 RECONNECTABLEDENY = 'reconnectable_deny.cfg'
 RECONNECTABLEALLOW = 'reconnectable_allow.cfg'
+TAPALLOW = 'tap_allow.cfg'
+STAT_INTERVAL = 1.0
+DNS_TTL = 300.0
+DNS_NEGATIVE_TTL = 60.0
+DNS_CACHE_SIZE = 4096
+DNS_WORKERS = 4
+FILECACHE_SIZE = 4096
+TAP_BUFFER_SIZE = 1048576
+TAP_QUEUE_SIZE = 256
+TAP_FILTER_LENGTH = 64
+DEBUGGER_NODE = 'Debugger'
+SERVERDIR = os.path.dirname(os.path.realpath(__file__))
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+#Message kinds returned by parse_message
+MSG_COMMAND = 0
+MSG_REPLY = 1
+MSG_EVENT = 2
+MSG_EMPTY = 3
+_MSG_KIND = {'@': MSG_REPLY, '_': MSG_EVENT, '': MSG_EMPTY}
+_MSG_PATTERN = re.compile(r"(?:([a-zA-Z_0-9.\-]+)>)?([a-zA-Z_0-9.\-]+)?\s*(.*)", re.DOTALL)
+_CMD_WORD = re.compile(r"(\S+)( |$)")
+_GROUP_NAME = re.compile(r"[a-zA-Z_0-9\-]+$")
+_TAP_NODE = re.compile(r"[a-zA-Z_0-9.\-*?]+$")
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+_DEFAULT_FLAGS = re.compile('').flags
 
 def get_hostlist():
     return HOSTLIST
@@ -33,56 +72,48 @@ def get_nodeidkey():
 def system_gettime(tin=None):
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tin))
 
-def system_gethostname_or_ip(sock, value='both'):
-    hostname = ''
-    ip, _unused = sock.getpeername()
-    try:
-        host = socket.gethostbyaddr(ip)
-        hostname = host[0]
-    except Exception as ex:
-        hostname = ip
-    if value == 'ip':
-        return ip
-    if value == 'host':
-        return hostname
-    if value == 'both':
-        return hostname, ip
-    return None
+def lookup_hostname(ip, callback):
+    """Return the host name of ip from the cache, or None and call callback(hostname) later from a worker thread."""
+    return _resolver.lookup(ip, callback)
+
+def set_iponly(iponly):
+    """Switch off reverse DNS lookups; the IP address is used as host name."""
+    _resolver.iponly = bool(iponly)
 
 def system_checkhost(l, hostname, ipadr, unchecked, libdir):
-    check = [hostname]
-    if hostname != ipadr:
-        check.append(ipadr)
-    allowedhost = starsfile.loadfiletolist(l, os.path.dirname(os.path.realpath(__file__)), libdir)
-    for entry in allowedhost:
-        entry = re.sub(r"\.", r"\.", entry)
-        entry = re.sub(r"\*", r".+", entry)
-        p = re.compile(r"^" + entry + r"$")
-        for c in check:
-            if p.match(c):
-                return True
+    acl = _hostacls.get(l, libdir)
+    if (acl is not None) and acl.check(hostname, ipadr):
+        return True
     return unchecked
 
-def check_term_and_host(nd, hd, libdir):
-    if not starsfile.checkfileexist(nd + '.allow', os.path.dirname(os.path.realpath(__file__)), libdir):
+def check_term_and_host(nd, host, ip, libdir):
+    acl = _hostacls.get(nd + '.allow', libdir)
+    if acl is None:
         return True
-    host, ip = system_gethostname_or_ip(hd)
-    if system_checkhost(nd + '.allow', host, ip, False, libdir):
-        return True
-    return False
+    return acl.check(host, ip)
 
 def check_nodekey(nname, nkeynum, nkeyval, keydir):
-    kcount = 0
-    if not starsfile.checkfileexist(nname + '.key', os.path.dirname(os.path.realpath(__file__)), keydir):
-        return False
-    kfile = starsfile.loadkeyfile(nname + '.key', os.path.dirname(os.path.realpath(__file__)), keydir)
-    kcount = kfile.__len__()
-    if kcount == 0:
+    kfile = _keyfiles.get(nname + '.key', keydir)
+    if not kfile:
         return False
-    kcount = nkeynum % kcount
-    if kfile[kcount] == nkeyval:
-        return True
-    return False
+    return kfile[nkeynum % len(kfile)] == nkeyval
+
+def system_loadkeys():
+    _keyfiles.clear()
+    return True
+
+def parse_message(buf):
+    """Split a message line "[from>]to[.sub] body" in one regex pass.
+
+    Returns (from_override, to, to_base, body, kind). from_override is None
+    if the line has no "from>" prefix, to and to_base are None if there is
+    no destination. kind is one of MSG_COMMAND, MSG_REPLY (body starts with
+    '@'), MSG_EVENT (body starts with '_') or MSG_EMPTY.
+    """
+    fromnode, tonode, body = _MSG_PATTERN.match(buf).groups()
+    if tonode is None:
+        return fromnode, None, None, body, _MSG_KIND.get(body[:1], MSG_COMMAND)
+    return fromnode, tonode, tonode.split('.', 1)[0], body, _MSG_KIND.get(body[:1], MSG_COMMAND)
 
 def isdenycheckcmd_deny(frm, to, buf, cmddeny):
     buf = re.search(r"^(\S+)( |$)", buf)
@@ -104,6 +135,88 @@ def isdenycheckcmd_allow(frm, to, buf, cmdallow):
             return False
     return True
 
+def compile_rules(rules):
+    """Compile a list of regex rules into one search function.
+
+    The rules are joined into a single alternation, so a line is checked with
+    one regex search regardless of the number of rules. Rules with back
+    references or inline global flags like (?i) would change the other rules
+    when joined, they are searched one by one. Rules that do not compile are
+    reported and ignored. Returns None for an empty list.
+    """
+    joined = []
+    separate = []
+    for rule in rules:
+        try:
+            compiled = re.compile(rule)
+        except re.error as ex:
+            print('Invalid rule ignored: ', rule, ex)
+            continue
+        if (compiled.flags != _DEFAULT_FLAGS) or _BACKREFERENCE.search(rule):
+            separate.append(compiled)
+        else:
+            joined.append(rule)
+    if joined:
+        try:
+            separate.insert(0, re.compile('|'.join('(?:%s)' %p for p in joined)))
+        except re.error:
+            separate[:0] = [re.compile(p) for p in joined]
+    if not separate:
+        return None
+    if len(separate) == 1:
+        return separate[0].search
+    return lambda line: any(p.search(line) for p in separate)
+
+class CommandPermission:
+    """Compiled command_deny.cfg/command_allow.cfg rules.
+
+    Gives the same decisions as isdenycheckcmd_deny/isdenycheckcmd_allow.
+    Decisions are cached per (from, to, command word) in a bounded LRU
+    cache; create a new instance to reload the rules.
+    """
+    def __init__(self, cmddeny=(), cmdallow=(), cachesize=CMDPERM_CACHE_SIZE):
+        self._deny = compile_rules(cmddeny)
+        self._allow = compile_rules(cmdallow)
+        self._decide = functools.lru_cache(maxsize=cachesize)(self._evaluate)
+        self._split = functools.lru_cache(maxsize=cachesize)(self._evaluatemembers)
+
+    def isdenied(self, frm, to, buf):
+        if (self._deny is None) and (self._allow is None):
+            return False
+        m = _CMD_WORD.match(buf)
+        if not m:
+            return True
+        return self._decide(frm, to, m.group())
+
+    def splitmembers(self, frm, to, members, buf):
+        """(allowed, denied) tuples of the members of the group addressed by to,
+        each member checked as the receiver. Cached per (from, group, command word)."""
+        if (self._deny is None) and (self._allow is None):
+            return members, ()
+        m = _CMD_WORD.match(buf)
+        if not m:
+            return (), members
+        return self._split(frm, to, members, m.group())
+
+    def _evaluatemembers(self, frm, to, members, word):
+        suffix = to[len(to.split('.', 1)[0]):]
+        allowed = []
+        denied = []
+        for member in members:
+            if self._evaluate(frm, member + suffix, word):
+                denied.append(member)
+            else:
+                allowed.append(member)
+        return tuple(allowed), tuple(denied)
+
+    def _evaluate(self, frm, to, word):
+        line = "%s>%s %s" %(frm, to, word)
+        if (self._deny is not None) and self._deny(line):
+            return True
+        if (self._allow is not None) and not self._allow(line):
+            return True
+        return False
+
 def isdenycheckreconnecttable_deny(node, host, reconndeny):
     for chk in reconndeny:
         if (re.match(r"^%s\s+%s$" %(node, host), chk)) or (re.match(r"^%s$" %node, chk)):
@@ -122,38 +235,483 @@ def system_listnodes(node):
 def system_listaliases(aliasreal):
     return " ".join(f"{k},{v}" for k, v in aliasreal.items())
 
-def check_reconnecttable(node, hd, reconndeny, reconnallow):
+def check_reconnecttable(node, host, reconndeny, reconnallow):
     if (not reconndeny) and (not reconnallow):
         return False
-    if ((reconndeny) and (isdenycheckreconnecttable_deny(node, system_gethostname_or_ip(hd, 'host'), reconndeny)))\
-        or ((reconnallow) and (isdenycheckreconnecttable_allow(node, system_gethostname_or_ip(hd, 'host'), reconnallow))):
+    if ((reconndeny) and (isdenycheckreconnecttable_deny(node, host, reconndeny)))\
+        or ((reconnallow) and (isdenycheckreconnecttable_allow(node, host, reconnallow))):
         return False
     return True
 
-def system_loadcommandpermission(libdir, cmddeny, cmdallow):
-    try:
-        cmddeny_new = starsfile.loadfiletolist(CMDDENY, os.path.dirname(os.path.realpath(__file__)), libdir)
-        cmdallow_new = starsfile.loadfiletolist(CMDALLOW, os.path.dirname(os.path.realpath(__file__)), libdir)
-        [cmddeny.append(x) for x in cmddeny_new if x not in cmddeny]
-        [cmdallow.append(x) for x in cmdallow_new if x not in cmdallow]
-        return True
-    except Exception:
-        return False
+def system_groupdef(groups, cmd, nodes, aliasreal):
+    """Define a group from "name member1 member2 ...". Members are stored as
+    node names with aliases resolved. Returns None or an error text."""
+    names = cmd.split()
+    if len(names) < 2:
+        return 'Parameter is not enough.'
+    name = names[0]
+    if (not _GROUP_NAME.match(name)) or (name == 'System'):
+        return 'Bad group name %s.' %name
+    if name in nodes:
+        return 'Node %s exists.' %name
+    members = []
+    for member in names[1:]:
+        member = aliasreal.get(member, member).split('.', 1)[0]
+        if (member == 'System') or (member in groups):
+            return 'Bad member %s.' %member
+        if member not in members:
+            members.append(member)
+    groups[name] = tuple(members)
+    return None
+
+def system_listgroups(groups):
+    return " ".join("%s:%s" %(name, ",".join(members)) for name, members in groups.items())
+
+class SendBuffer:
+    """Outbound byte buffer of one socket.
+
+    Messages are appended as encoded bytes and sent with one scatter/gather
+    sendmsg() call per flush. A partially sent chunk is kept as a memoryview,
+    so pending data is never copied, re-encoded or decoded.
+    """
+    __slots__ = ('_chunks', '_size')
+
+    def __init__(self):
+        self._chunks = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def clear(self):
+        self._chunks.clear()
+        self._size = 0
+
+    def send(self, sock):
+        """Send as much as the socket accepts and return the number of bytes sent."""
+        chunks = self._chunks
+        if not chunks:
+            return 0
+        if (len(chunks) == 1) or (not HAS_SENDMSG):
+            sent = sock.send(chunks[0])
+        else:
+            sent = sock.sendmsg(list(itertools.islice(chunks, IOV_MAX)))
+        self._size -= sent
+        rest = sent
+        while rest:
+            head = chunks[0]
+            if rest >= len(head):
+                chunks.popleft()
+                rest -= len(head)
+            else:
+                chunks[0] = memoryview(head)[rest:]
+                rest = 0
+        return sent
+
+    def sendall(self, sock):
+        """Send everything on a blocking socket."""
+        while self._chunks:
+            self.send(sock)
+
+class LineTooLongError(ValueError):
+    pass
+
+class LineFramer:
+    """Splits a byte stream into lines.
+
+    Received bytes are appended to a bytearray which is scanned for b"\\n"
+    only from where the previous scan stopped. Only complete lines are
+    decoded; the unconsumed tail stays in place. Trailing \\r characters and
+    empty lines are dropped. LineTooLongError is raised when the tail grows
+    beyond maxline bytes without a newline.
+    """
+    __slots__ = ('_buf', '_scanned', '_maxline')
+
+    def __init__(self, maxline=None):
+        self._buf = bytearray()
+        self._scanned = 0
+        self._maxline = maxline or MAX_LINE_LENGTH
+
+    def __len__(self):
+        return len(self._buf)
 
-def system_loadaliases(libdir, aliasreal, realalias):
-    try:
-        starsfile.loadfiletodictionary(ALIASES, os.path.dirname(os.path.realpath(__file__)), libdir, aliasreal, realalias)
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        lines = []
+        start = 0
+        pos = buf.find(b'\n', self._scanned)
+        while pos >= 0:
+            end = pos
+            while (end > start) and (buf[end - 1] == 13):
+                end -= 1
+            if end > start:
+                lines.append(buf[start:end].decode('utf8', 'replace'))
+            start = pos + 1
+            pos = buf.find(b'\n', start)
+        if start:
+            del buf[:start]
+        self._scanned = len(buf)
+        if self._scanned > self._maxline:
+            buf.clear()
+            self._scanned = 0
+            raise LineTooLongError('Line exceeds %d bytes.' %self._maxline)
+        return lines
+
+class LatencyStats:
+    """Count, mean and maximum of all samples plus percentiles of the latest ones (seconds)."""
+    __slots__ = ('count', 'total', 'maximum', '_samples')
+
+    def __init__(self, samples=1024):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self._samples = deque(maxlen=samples)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+        self._samples.append(seconds)
+
+    def percentile(self, p):
+        samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    def summary(self):
+        avg = self.total / self.count if self.count else 0.0
+        return "count=%d avg=%.1fms p50=%.1fms p99=%.1fms max=%.1fms" %(self.count, avg * 1000,
+            self.percentile(50) * 1000, self.percentile(99) * 1000, self.maximum * 1000)
+
+class FlgonTable:
+    """Subscriptions registered with System flgon.
+
+    _watch maps a subscriber to the set of names it watches. Two reverse
+    indexes are kept up to date by add/remove: _index maps a watched name
+    to its subscribers (used for events) and _nodeindex maps the node part
+    of a watched name (Dev1 for Dev1.pm1) to its subscribers with a
+    reference count (used for _Connected/_Disconnected).
+    _bynode maps a node to the subscriber names it registered with, so
+    they can be dropped when the node disconnects.
+    _targets caches the receivers of events as (node, subscriber, encoded
+    subscriber) tuples per watched name or node, until they change. A list
+    built while add/remove run in another thread is not cached.
+    """
+    def __init__(self):
+        self._watch = {}
+        self._index = {}
+        self._nodeindex = {}
+        self._bynode = {}
+        self._targets = {}
+        self._generation = 0
+
+    def __contains__(self, subscriber):
+        return subscriber in self._watch
+
+    def add(self, subscriber, name):
+        watch = self._watch.get(subscriber)
+        if watch is None:
+            watch = self._watch[subscriber] = set()
+            self._bynode.setdefault(subscriber.split('.', 1)[0], set()).add(subscriber)
+        elif name in watch:
+            return False
+        watch.add(name)
+        self._index.setdefault(name, set()).add(subscriber)
+        base = name.split('.', 1)[0]
+        self._generation += 1
+        self._targets.pop(name, None)
+        self._targets.pop((base,), None)
+        refs = self._nodeindex.setdefault(base, {})
+        refs[subscriber] = refs.get(subscriber, 0) + 1
         return True
-    except Exception:
-        return False
 
-def system_loadreconnecttablepermission(libdir, reconndeny, reconnallow):
-    try:
-        #2023-01-30 (Mon) Substitution was changed into extend by T.Kosuge.
-        reconndeny_new = starsfile.loadfiletolist(RECONNECTABLEDENY, os.path.dirname(os.path.realpath(__file__)), libdir)
-        reconnallow_new = starsfile.loadfiletolist(RECONNECTABLEALLOW, os.path.dirname(os.path.realpath(__file__)), libdir)
-        [reconndeny.append(x) for x in reconndeny_new if x not in reconndeny]
-        [reconnallow.append(x) for x in reconnallow_new if x not in reconnallow]
+    def remove(self, subscriber, name):
+        watch = self._watch.get(subscriber)
+        if (watch is None) or (name not in watch):
+            return False
+        watch.discard(name)
+        if not watch:
+            del self._watch[subscriber]
+            node = subscriber.split('.', 1)[0]
+            self._bynode[node].discard(subscriber)
+            if not self._bynode[node]:
+                del self._bynode[node]
+        subscribers = self._index[name]
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._index[name]
+        base = name.split('.', 1)[0]
+        self._generation += 1
+        self._targets.pop(name, None)
+        self._targets.pop((base,), None)
+        refs = self._nodeindex[base]
+        refs[subscriber] -= 1
+        if refs[subscriber] == 0:
+            del refs[subscriber]
+            if not refs:
+                del self._nodeindex[base]
         return True
-    except Exception:
+
+    def subscribers(self, name):
+        """Subscribers watching exactly name."""
+        return self._index.get(name, ())
+
+    def nodesubscribers(self, node):
+        """Subscribers watching node or any name below it (node.xxx)."""
+        return self._nodeindex.get(node, ())
+
+    def targets(self, name):
+        """subscribers(name) as (node, subscriber, encoded subscriber) tuples."""
+        targets = self._targets.get(name)
+        if targets is None:
+            targets = self._cachetargets(name, self.subscribers(name))
+        return targets
+
+    def nodetargets(self, node):
+        """nodesubscribers(node) as (node, subscriber, encoded subscriber) tuples."""
+        targets = self._targets.get((node,))
+        if targets is None:
+            targets = self._cachetargets((node,), self.nodesubscribers(node))
+        return targets
+
+    def _cachetargets(self, key, subscribers):
+        generation = self._generation
+        targets = tuple((name.split('.', 1)[0], name, name.encode()) for name in tuple(subscribers))
+        if generation == self._generation:
+            self._targets[key] = targets
+        return targets
+
+    def dropnode(self, node):
+        """Remove all subscriptions registered by node and its sub names."""
+        for subscriber in list(self._bynode.get(node, ())):
+            for name in list(self._watch.get(subscriber, ())):
+                self.remove(subscriber, name)
+
+class Tap:
+    """Monitoring tap registered with System tap.
+
+    The filter is a node name for the sender, one for the receiver and a
+    command word, each literal or a glob with * and ?, matched against the
+    routed line "from>to command ...". Globs are translated by fnmatch,
+    clients can not send regular expressions. A tap without filter gets
+    every line, like the Debugger node always did. Raises ValueError for an
+    invalid filter. queued holds the sizes of the latest copies, for
+    servers that only know how many messages wait in a channel.
+    """
+    __slots__ = ('node', 'spec', 'copied', 'dropped', 'queued', '_frm', '_to', '_cmd')
+
+    def __init__(self, node, frm=None, to=None, cmd=None):
+        self.node = node
+        self.copied = 0
+        self.dropped = 0
+        self.queued = deque()
+        if (frm, to, cmd) == (None, None, None):
+            self.spec = '*'
+            self._frm = self._to = self._cmd = None
+            return
+        frm, to, cmd = (p if p is not None else '*' for p in (frm, to, cmd))
+        for p in (frm, to, cmd):
+            if len(p) > TAP_FILTER_LENGTH:
+                raise ValueError('filter longer than %d characters' %TAP_FILTER_LENGTH)
+        for p in (frm, to):
+            if not _TAP_NODE.match(p):
+                raise ValueError('bad node name %s' %p)
+        self.spec = '%s>%s %s' %(frm, to, cmd)
+        self._frm, self._to, self._cmd = (None if p == '*' else re.compile(fnmatch.translate(p)).match for p in (frm, to, cmd))
+
+    def matches(self, line):
+        if (self._frm is None) and (self._to is None) and (self._cmd is None):
+            return True
+        frm, _unused, rest = line.partition('>')
+        to, _unused, rest = rest.partition(' ')
+        words = rest.split(None, 1)
+        return ((self._frm is None) or (self._frm(frm) is not None))\
+            and ((self._to is None) or (self._to(to) is not None))\
+            and ((self._cmd is None) or (self._cmd(words[0] if words else '') is not None))
+
+    def summary(self):
+        return "%s(%s) copied=%d dropped=%d" %(self.node, self.spec, self.copied, self.dropped)
+
+def isallowedtap(node, tapallow):
+    """Taps are denied by default, allowed for the Debugger node and the nodes in tap_allow.cfg."""
+    return (node == DEBUGGER_NODE) or (node in tapallow)
+
+class FileCache:
+    """Lib files parsed once and kept in memory.
+
+    get() returns loader(filename, libdir) for an existing file and None for a
+    missing one. The file is stat()ed again at most every STAT_INTERVAL
+    seconds and reloaded only when its mtime or size has changed. Missing
+    files are cached too; they are dropped first when more than maxentries
+    names have been looked up.
+    """
+    def __init__(self, loader, interval=STAT_INTERVAL, maxentries=FILECACHE_SIZE):
+        self._loader = loader
+        self._interval = interval
+        self._maxentries = maxentries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename, libdir):
+        key = (filename, libdir)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if (entry is not None) and (now < entry[2]):
+            return entry[0]
+        try:
+            st = os.stat(os.path.join(SERVERDIR, libdir, filename))
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        with self._lock:
+            if (entry is not None) and (entry[1] == stamp):
+                entry[2] = now + self._interval
+                return entry[0]
+            value = None
+            if stamp is not None:
+                try:
+                    value = self._loader(filename, libdir)
+                except (OSError, UnicodeDecodeError) as ex:
+                    print('Can\'t load file: ', filename, ex)
+            if (entry is None) and (len(self._entries) >= self._maxentries):
+                self._shrink()
+            self._entries[key] = [value, stamp, now + self._interval]
+            return value
+
+    def _shrink(self):
+        for key in [k for k, e in self._entries.items() if e[1] is None]:
+            del self._entries[key]
+        if len(self._entries) >= self._maxentries:
+            self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class HostAcl:
+    """Compiled host allow list (allow.cfg, <node>.allow).
+
+    Entries that are IP addresses or networks (192.168.11.0/24) are matched
+    with ipaddress, grouped by prefix length. All other entries keep the
+    wildcard syntax (* matches anything, regex character classes allowed)
+    and are joined into one anchored regex.
+    """
+    __slots__ = ('_networks', '_match')
+
+    def __init__(self, entries):
+        self._networks = {}
+        patterns = []
+        for entry in entries:
+            try:
+                net = ipaddress.ip_network(entry, strict=False)
+                self._networks.setdefault((net.version, int(net.netmask)), set()).add(int(net.network_address))
+                continue
+            except ValueError:
+                pass
+            entry = re.sub(r"\.", r"\.", entry)
+            entry = re.sub(r"\*", r".+", entry)
+            try:
+                re.compile(entry)
+                patterns.append(entry)
+            except re.error as ex:
+                print('Invalid host entry ignored: ', entry, ex)
+        self._match = None
+        if patterns:
+            self._match = re.compile(r"^(?:" + '|'.join('(?:%s)' %p for p in patterns) + r")$").match
+
+    def check(self, hostname, ipadr):
+        if self._networks:
+            try:
+                ip = ipaddress.ip_address(ipadr)
+                ipint = int(ip)
+                for (version, mask), addresses in self._networks.items():
+                    if (version == ip.version) and ((ipint & mask) in addresses):
+                        return True
+            except ValueError:
+                pass
+        if self._match is not None:
+            if self._match(hostname) or ((hostname != ipadr) and self._match(ipadr)):
+                return True
         return False
+
+def _loadhostacl(filename, libdir):
+    return HostAcl(starsfile.loadfiletolist(filename, SERVERDIR, libdir))
+
+def _loadkeyfile(filename, keydir):
+    return tuple(starsfile.loadkeyfile(filename, SERVERDIR, keydir))
+
+class Resolver:
+    """Reverse DNS lookups with a TTL cache.
+
+    Successful lookups are cached for ttl seconds, failed ones (host name
+    falls back to the IP address) for negttl seconds. lookup() with a
+    callback never blocks: on a cache miss the lookup runs on a small
+    thread pool and concurrent requests for the same IP share it.
+    """
+    def __init__(self, ttl=DNS_TTL, negttl=DNS_NEGATIVE_TTL, workers=DNS_WORKERS, maxentries=DNS_CACHE_SIZE):
+        self.iponly = False
+        self._ttl = ttl
+        self._negttl = negttl
+        self._workers = workers
+        self._maxentries = maxentries
+        self._cache = {}
+        self._pending = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def lookup(self, ip, callback=None):
+        if self.iponly:
+            return ip
+        entry = self._cache.get(ip)
+        if (entry is not None) and (time.monotonic() < entry[1]):
+            return entry[0]
+        if callback is None:
+            return self._resolve(ip)
+        with self._lock:
+            if ip in self._pending:
+                self._pending[ip].append(callback)
+                return None
+            self._pending[ip] = [callback]
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='Resolver')
+        self._executor.submit(self._resolve_pending, ip)
+        return None
+
+    def _resolve(self, ip):
+        try:
+            hostname = socket.gethostbyaddr(ip)[0]
+            ttl = self._ttl
+        except Exception:
+            hostname = ip
+            ttl = self._negttl
+        now = time.monotonic()
+        if len(self._cache) >= self._maxentries:
+            with self._lock:
+                for key in [k for k, e in self._cache.items() if e[1] <= now]:
+                    del self._cache[key]
+                if len(self._cache) >= self._maxentries:
+                    self._cache.clear()
+        self._cache[ip] = (hostname, now + ttl)
+        return hostname
+
+    def _resolve_pending(self, ip):
+        hostname = self._resolve(ip)
+        with self._lock:
+            callbacks = self._pending.pop(ip, ())
+        for callback in callbacks:
+            try:
+                callback(hostname)
+            except Exception as ex:
+                print('Exception occurred: ', ex)
+
+_resolver = Resolver()
+_hostacls = FileCache(_loadhostacl)
+_keyfiles = FileCache(_loadkeyfile)